@@ -0,0 +1,787 @@
+# Palazzetti Connection Box client, independent of Domoticz
+#
+# Protocol knowledge of the Connection Box: API URIs and JSON keys, status and alarm codes, fan and power levels,
+# command encoding and response decoding into a typed stove state, weekly chrono program (Chrono).
+# The asyncio Client talks HTTP/1.1 to a box on pooled keep-alive connections; pollMany() polls several boxes
+# concurrently from one event loop:
+#
+#   clients = [palazzetti.Client("192.168.1.20"), palazzetti.Client("192.168.1.21", api="php")]
+#   for state in await palazzetti.pollMany(clients):
+#       print(state.label, state.roomTemperature)
+#
+import json
+import zlib
+import asyncio
+
+# Starting mid-2018, Palazzetti has released a new software and the API URLs changed from PHP to LUA
+API_URIS = { "lua": "/cgi-bin/sendmsg.lua",
+             "php": "/sendmsg.php" }
+
+# JSON keys used in results
+JSON_KEYS = {
+        "php" : {
+            "INFO_KEY": "Info",
+            "ALL_DATA_KEY": "All Data",
+            "STATUS": "STATUS",
+            "POWER": "POWER",
+            "CHRSTATUS": "CHRSTATUS",
+            "SETP": "SETP",
+            "PELLET_QTUSED": "PELLET_QTUSED",
+            "TMP_ROOM": "TMP_ROOM_WATER",
+            "TMP_PELLET_BACKW": "TMP_PELLET_BACKW",
+            "TMP_EXHAUST": "TMP_EXHAUST",
+            "FAN_FAN2LEVEL": "FAN_FAN2LEVEL",
+            "FAN_FAN1V": "FAN_FAN1V",
+            "FAN_FAN1RPM": "FAN_FAN1RPM",
+            "FAN_FAN2V": "FAN_FAN2V",
+            "ONTIME": "ONTIME",
+            "SERVICETIME": "SERVICETIME",
+            "FIRMWARE": "SYSTEM" },
+        "lua" : {
+            "INFO_KEY": "INFO",
+            "DATA_KEY": "DATA",
+            "STATUS": "STATUS",
+            "POWER": "PWR",
+            "CHRSTATUS": "CHRSTATUS",
+            "SETP": "SETP",
+            "PELLET_QTUSED": "PQT",
+            "TMP_ROOM": "T5",
+            "TMP_PELLET_BACKW": "T2",
+            "TMP_EXHAUST": "T3",
+            "FAN_FAN2LEVEL": "F2L",
+            "FAN_FAN1V": "F1V",
+            "FAN_FAN1RPM": "F1RPM",
+            "FAN_FAN2V": "F2V",
+            "ONTIME": "ONTIME",
+            "SERVICETIME": "SERVICETIME",
+            "FIRMWARE": "VER" }
+    }
+
+# Containers of the data in the responses, the most frequent first
+RESPONSE_CONTAINERS = {
+        "php" : ("All Data", "Setpoint", "Status", "RoomFan", "Power", "Counters", "Chrono Info"),
+        "lua" : ("DATA", "Setpoint", "Status", "RoomFan", "Power", "Counters", "Chrono Info")
+    }
+
+# Container of the reply of a command family, when it is not the first container of the API
+REPLY_CONTAINERS = {
+        "php" : { "GET+CHRD": "Chrono Info",
+                  "GET+CNTR": "Counters",
+                  "SET+SETP": "Setpoint",
+                  "SET+RFAN": "RoomFan",
+                  "SET+POWR": "Power",
+                  "SET+CSST": "Chrono Info",
+                  "SET+CPRD": "Chrono Info",
+                  "SET+CDAY": "Chrono Info",
+                  "CMD": "Status" },
+        "lua" : {}
+    }
+
+STATUS_CODES = { "0": "OFF",
+                 "1": "OFF TIMER",
+                 "2": "TESTFIRE",
+                 "3": "HEATUP",
+                 "4": "FUELIGN",
+                 "5": "IGNTEST",
+                 "6": "BURNING",
+                 "9": "COOLFLUID",
+                 "10": "FIRESTOP",
+                 "11": "CLEANFIRE",
+                 "12": "COOL" }
+
+ALARM_CODES = { "241": "CHIMNEY ALARM",
+                "243": "GRATE ERROR",
+                "244": "NTC2 ALARM",
+                "245": "NTC3 ALARM",
+                "247": "DOOR ALARM",
+                "248": "PRESS ALARM",
+                "249": "NTC1 ALARM",
+                "250": "TC1 ALARM",
+                "252": "GAS ALARM",
+                "253": "NOPELLET ALARM" }
+
+# Stove status codes during which the status changes quickly: HEATUP, FUELIGN, IGNTEST, FIRESTOP, CLEANFIRE
+TRANSITIONAL_STATUS = (3, 4, 5, 10, 11)
+# status codes from this one are alarms (see ALARM_CODES)
+ALARM_STATUS = 240
+STATUS_OFF = 0
+# the stove burns pellets: TESTFIRE to BURNING
+BURNING_STATUS = (2, 3, 4, 5, 6)
+STATUS_NOPELLET = 253
+
+# Room fan levels (FAN_FAN2LEVEL, SET RFAN): 1 to 5, and these ones
+FAN_AUTO = 0
+FAN_HI = 6
+FAN_OFF = 7
+# Power levels (POWER, SET POWR)
+POWER_MIN = 1
+POWER_MAX = 5
+# Temperature setpoints (SETP, SET SETP), in °C
+SETPOINT_MIN = 5
+SETPOINT_MAX = 50
+
+# Chrono: programs (start, stop, setpoint), and the programs run by the slots of each day, Monday first
+CHRONO_PROGRAMS = 6
+CHRONO_DAYS = 7
+CHRONO_SLOTS = 3
+# commands addressing one element of a list, with the number of indexes that follow their name (see commandFamily)
+INDEXED_COMMANDS = { "SET+CPRD": 1,   # SET+CPRD+program+setpoint+start hour+start minute+stop hour+stop minute
+                     "SET+CDAY": 2 }  # SET+CDAY+day+slot+program
+
+
+def parseHours(value):
+    """Duration of the stove counters, "hours:minutes" (e.g. "2404:07") or a number of hours, in hours"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    hours, sep, minutes = str(value).partition(":")
+    return int(hours) + int(minutes or 0) / 60
+
+# Fields decoded by default, with their converter, in decoding order: STATUS first, as other fields depend on it
+FIELDS = (("STATUS", int),
+          ("POWER", int),
+          ("FAN_FAN2LEVEL", int),
+          ("SETP", float),
+          ("TMP_ROOM", float),
+          ("PELLET_QTUSED", int),
+          ("CHRSTATUS", int),
+          ("TMP_PELLET_BACKW", float),
+          ("TMP_EXHAUST", float),
+          ("FAN_FAN1V", float),
+          ("FAN_FAN1RPM", int),
+          ("FAN_FAN2V", float),
+          ("ONTIME", parseHours),
+          ("SERVICETIME", parseHours))
+
+
+def statusLabel(status, statusCodes = STATUS_CODES, alarmCodes = ALARM_CODES):
+    """Label of a stove status code"""
+    label = statusCodes.get(str(status))
+    if label is None:
+        label = alarmCodes.get(str(status), "ALARM "+str(status) if status >= ALARM_STATUS else str(status))
+    return label
+
+def isRunning(status):
+    """True if the stove is running for a status code: from TESTFIRE to COOL"""
+    return 2 <= status <= 12
+
+def commandName(command):
+    """Name of a cbox command, e.g. SET+SETP for SET+SETP+21, CMD for CMD+ON and CMD+OFF"""
+    parts = command.split("+", 2)
+    if parts[0] == "CMD":
+        return "CMD"
+    return "+".join(parts[:2])
+
+def commandFamily(command):
+    """Family of a cbox command: commands of the same family overwrite each other. It is the command name, with the
+    indexes of the element addressed for the INDEXED_COMMANDS: SET+SETP for SET+SETP+21, SET+CDAY+1+2 for SET+CDAY+1+2+3"""
+    name = commandName(command)
+    indexes = INDEXED_COMMANDS.get(name)
+    if indexes is None:
+        return name
+    return "+".join(command.split("+", 2 + indexes)[:2 + indexes])
+
+def switchCommand(on):
+    """Command switching the stove on or off"""
+    return "CMD+ON" if on else "CMD+OFF"
+
+def setpointCommand(setpoint):
+    """Command setting the temperature setpoint, in whole degrees, SETPOINT_MIN to SETPOINT_MAX"""
+    if not SETPOINT_MIN <= setpoint <= SETPOINT_MAX:
+        raise ValueError("Invalid setpoint: "+str(setpoint))
+    return "SET+SETP+"+str(int(setpoint))
+
+def fanCommand(fanLevel):
+    """Command setting the room fan level: 1 to 5, FAN_AUTO, FAN_HI or FAN_OFF"""
+    if not FAN_AUTO <= fanLevel <= FAN_OFF:
+        raise ValueError("Invalid fan level: "+str(fanLevel))
+    return "SET+RFAN+"+str(int(fanLevel))
+
+def powerCommand(power):
+    """Command setting the power level, POWER_MIN to POWER_MAX"""
+    if not POWER_MIN <= power <= POWER_MAX:
+        raise ValueError("Invalid power level: "+str(power))
+    return "SET+POWR+"+str(int(power))
+
+def chronoCommand(on):
+    """Command enabling or disabling the chrono (timer)"""
+    return "SET+CSST+1" if on else "SET+CSST+0"
+
+def parseTime(value):
+    """(hour, minute) of a "hh:mm" time of the chrono"""
+    hour, sep, minute = str(value).partition(":")
+    hour, minute = int(hour), int(minute)
+    if not (sep and 0 <= hour <= 23 and 0 <= minute <= 59):
+        raise ValueError("Invalid time: "+str(value))
+    return hour, minute
+
+def chronoProgramCommand(program, start, stop, setpoint):
+    """Command setting a chrono program (1 to CHRONO_PROGRAMS): start and stop times ("hh:mm") and setpoint"""
+    if not 1 <= program <= CHRONO_PROGRAMS:
+        raise ValueError("Invalid chrono program: "+str(program))
+    return "SET+CPRD+%d+%d+%d+%d+%d+%d" % ((program, setpoint) + parseTime(start) + parseTime(stop))
+
+def chronoDayCommand(day, slot, program):
+    """Command setting the program (0 for OFF) run by a slot (1 to CHRONO_SLOTS) of a day (1 to CHRONO_DAYS, Monday)"""
+    if not (1 <= day <= CHRONO_DAYS and 1 <= slot <= CHRONO_SLOTS and 0 <= program <= CHRONO_PROGRAMS):
+        raise ValueError("Invalid chrono day slot: %d %d %d" % (day, slot, program))
+    return "SET+CDAY+%d+%d+%d" % (day, slot, program)
+
+# command name -> encoder of the SET commands, called with the integer arguments of the command
+SET_ENCODERS = { "SET+SETP": setpointCommand,
+                 "SET+RFAN": fanCommand,
+                 "SET+POWR": powerCommand,
+                 "SET+CSST": lambda on: chronoCommand({ 0: False, 1: True }[on]),
+                 "SET+CPRD": lambda program, setpoint, startHour, startMinute, stopHour, stopMinute:
+                     chronoProgramCommand(program, "%d:%d" % (startHour, startMinute), "%d:%d" % (stopHour, stopMinute), setpoint),
+                 "SET+CDAY": chronoDayCommand }
+
+def checkCommand(command):
+    """Command of an outside client (e.g. "SET+POWR+3") rebuilt with the encoders: raises ValueError for an unknown
+    command or a value out of range. GET commands only read the box, they are returned as is"""
+    if command.startswith("GET+") and all(c.isalnum() or c in "+.-" for c in command):
+        return command
+    if command in ("CMD+ON", "CMD+OFF"):
+        return switchCommand(command == "CMD+ON")
+    encoder = SET_ENCODERS.get(commandName(command))
+    args = command.split("+")[2:]
+    if encoder is None or not all(arg.isdigit() for arg in args):
+        raise ValueError("Invalid command: "+command)
+    try:
+        return encoder(*map(int, args))
+    except (TypeError, KeyError):
+        # wrong number of arguments, CSST not 0 or 1
+        raise ValueError("Invalid command: "+command)
+
+def parseReply(body):
+    """JSON object of a reply body, None if it is malformed. Obviously bad bodies are rejected before parsing"""
+    if body[:1] != b"{" and body.lstrip()[:1] != b"{":
+        return None
+    if body[-1:] != b"}" and body.rstrip()[-1:] != b"}":
+        return None
+    try:
+        reply = json.loads(body)
+    except ValueError:
+        # UnicodeDecodeError and JSONDecodeError
+        return None
+    return reply if isinstance(reply, dict) else None
+
+
+class BodyAssembler:
+    """Reassembles the body of a reply delivered in several fragments by the connection.
+
+    Content-Length or the chunk framing tells when a body is complete. A body delivered in one piece (the usual
+    case) is returned as is, without any copy. Used by the Client, and by the Domoticz plugin whose connection
+    delivers the replies in fragments.
+    """
+
+    MAX_BODY = 65536
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.expected = -1
+        self.chunked = False
+        self.assembling = False
+        self.fragments = 0
+        self.dropped = 0
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.expected = -1
+        self.chunked = False
+        self.assembling = False
+
+    def feed(self, data, headers = None):
+        """Complete body (bytes or bytearray), None if more fragments are needed. headers: the headers of the reply,
+        with its first fragment only. Raises ValueError on bad framing"""
+        data = data or b""
+
+        if self.assembling and headers:
+            # a new reply starts: the previous one will never be complete
+            self.dropped += 1
+            self.reset()
+
+        if not self.assembling:
+            length = -1
+            if headers:
+                length = int(headers.get("Content-Length", headers.get("content-length", -1)))
+                self.chunked = (headers.get("Transfer-Encoding", headers.get("transfer-encoding", "")).lower() == "chunked")
+            if self.chunked and isChunkFramed(data):
+                # complete when decodeChunks says so, even if the first fragment ends within a chunk size
+                pass
+            elif length < 0 or len(data) >= length:
+                self.chunked = False
+                return data
+            else:
+                self.chunked = False
+            self.expected = length
+            self.assembling = True
+
+        self.buffer += data
+        self.fragments += 1
+        if len(self.buffer) > self.MAX_BODY:
+            self.reset()
+            raise ValueError("reply larger than "+str(self.MAX_BODY)+" bytes")
+
+        if self.chunked:
+            try:
+                body = decodeChunks(self.buffer)
+            except ValueError:
+                # the rest of this reply cannot be framed either
+                self.reset()
+                raise
+            if body is None:
+                return None
+        elif len(self.buffer) < self.expected:
+            return None
+        else:
+            body = self.buffer
+
+        self.reset()
+        return body
+
+HEX_DIGITS = frozenset(b"0123456789abcdefABCDEF")
+
+def isChunkFramed(data):
+    # a chunked body starts with the hexadecimal size of the first chunk; a body whose framing was already removed
+    # by the connection (Transfer-Encoding header kept) starts with '{'
+    return len(data) == 0 or data[0] in HEX_DIGITS
+
+def decodeChunks(buffer):
+    """Body of a complete chunked message, None if incomplete. Raises ValueError on bad framing"""
+    body = bytearray()
+    pos = 0
+    while True:
+        end = buffer.find(b"\r\n", pos)
+        if end < 0:
+            return None
+        size = int(buffer[pos:end].split(b";")[0], 16)
+        if size == 0:
+            # the last chunk, then the optional trailers and an empty line
+            if buffer.find(b"\r\n\r\n", end) < 0:
+                return None
+            return body
+        start = end + 2
+        if len(buffer) < start + size + 2:
+            return None
+        body += buffer[start:start + size]
+        pos = start + size + 2
+
+
+class ResponseDecoder:
+    """Decodes the payload of the Connection Box responses for one API.
+
+    The decoding table is compiled once: each entry maps a JSON key to a field name and a converter; the converter
+    of the first entry of a field is used. Entries are processed in table order, so that e.g. STATUS is known before
+    the fields that depend on it.
+    """
+
+    def __init__(self, api, fields = FIELDS):
+        keys = JSON_KEYS[api]
+        self.infoKey = keys["INFO_KEY"]
+        self.firmwareKey = keys["FIRMWARE"]
+        self.containers = RESPONSE_CONTAINERS[api]
+        # command family -> container of its reply, when it is not the first container
+        self.replyContainers = REPLY_CONTAINERS[api]
+        # (JSON key, field, converter) for the fields of this API
+        table = []
+        known = set()
+        for field, converter in fields:
+            if field in keys and field not in known:
+                known.add(field)
+                table.append((keys[field], field, converter))
+        self.table = tuple(table)
+        self.keys = tuple(key for key, field, converter in self.table)
+        self.errors = 0
+
+    def isOK(self, response):
+        """True if the box reports success in its response"""
+        info = response.get(self.infoKey)
+        return isinstance(info, dict) and info.get("RSP") == "OK"
+
+    def payload(self, response):
+        """(tag, data) of a response: data is the dict holding the data (None if there is none), tag identifies
+        the command answered: the command echoed by the LUA API, or the data container"""
+        container = data = None
+        for name in self.containers:
+            data = response.get(name)
+            if data is not None:
+                container = name
+                break
+
+        info = response.get(self.infoKey)
+        command = info.get("CMD") if isinstance(info, dict) else None
+        if command:
+            return command.replace(" ", "+"), data
+        return container, data
+
+    def expectedTags(self, command):
+        """Tags that a reply to command can have"""
+        return (command, self.replyContainers.get(commandName(command), self.containers[0]))
+
+    def fingerprint(self, data):
+        """Raw values of the mapped fields in data, equal for two payloads that decode to the same state"""
+        return tuple(map(data.get, self.keys))
+
+    def firmware(self, data):
+        """Software version of the box reported in a GET ALLS payload, None if there is none"""
+        version = data.get(self.firmwareKey)
+        return None if version is None else str(version)
+
+    def supported(self, data):
+        """Mapped fields present in a GET ALLS payload, in table order"""
+        return [field for key, field, converter in self.table if key in data]
+
+    def decode(self, data):
+        """Single pass over the mapped fields present in data, returns {field: converted value}"""
+        state = {}
+        for key, field, converter in self.table:
+            raw = data.get(key)
+            if raw is not None:
+                try:
+                    state[field] = converter(raw)
+                except (TypeError, ValueError):
+                    self.errors += 1
+        return state
+
+
+class StoveState:
+    """State of a stove, updated with the fields decoded with the default FIELDS. Unknown values are None"""
+
+    # field -> attribute
+    ATTRIBUTES = { "STATUS": "status",
+                   "POWER": "power",
+                   "FAN_FAN2LEVEL": "fanLevel",
+                   "SETP": "setpoint",
+                   "TMP_ROOM": "roomTemperature",
+                   "PELLET_QTUSED": "pelletsUsed",
+                   "CHRSTATUS": "chrono",
+                   "TMP_PELLET_BACKW": "pelletBackwallTemperature",
+                   "TMP_EXHAUST": "exhaustTemperature",
+                   "FAN_FAN1V": "exhaustFanVoltage",
+                   "FAN_FAN1RPM": "exhaustFanRpm",
+                   "FAN_FAN2V": "roomFanVoltage",
+                   "ONTIME": "onTime",
+                   "SERVICETIME": "serviceTime" }
+    __slots__ = tuple(ATTRIBUTES.values())
+
+    def __init__(self, fields = None):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        if fields:
+            self.update(fields)
+
+    def update(self, fields):
+        """Apply decoded fields, unknown fields are ignored"""
+        for field, value in fields.items():
+            name = self.ATTRIBUTES.get(field)
+            if name is not None:
+                setattr(self, name, value)
+
+    @property
+    def isOn(self):
+        """True if the stove is running (from TESTFIRE to COOL), None if the status is unknown"""
+        return isRunning(self.status) if self.status is not None else None
+
+    @property
+    def alarm(self):
+        """Alarm status code, None if there is no alarm"""
+        return self.status if self.status is not None and self.status >= ALARM_STATUS else None
+
+    @property
+    def label(self):
+        return statusLabel(self.status) if self.status is not None else None
+
+    def asDict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def fields(self):
+        """{field: value} of the known values, the reverse of update()"""
+        return dict((field, getattr(self, name)) for field, name in self.ATTRIBUTES.items() if getattr(self, name) is not None)
+
+    def __repr__(self):
+        return "StoveState(" + ", ".join(name+"="+repr(getattr(self, name)) for name in self.__slots__ if getattr(self, name) is not None) + ")"
+
+
+class Chrono:
+    """Weekly chrono program of a stove: CHRONO_PROGRAMS programs [start, stop, setpoint] (e.g. ["06:30", "08:30", 21]),
+    and for each day the programs run by its CHRONO_SLOTS slots (0 for OFF). Programs and days are numbered from 1
+    in the commands and the replies of the box, from 0 in the lists.
+
+    The version is a stamp of the content, equal for equal programs.
+    """
+
+    def __init__(self, programs, days):
+        if len(programs) != CHRONO_PROGRAMS or len(days) != CHRONO_DAYS or any(len(slots) != CHRONO_SLOTS for slots in days):
+            raise ValueError("Invalid chrono size")
+        self.programs = [["%02d:%02d" % parseTime(start), "%02d:%02d" % parseTime(stop), int(setpoint)] for start, stop, setpoint in programs]
+        self.days = [[int(program) for program in slots] for slots in days]
+        if any(not 0 <= program <= CHRONO_PROGRAMS for slots in self.days for program in slots):
+            raise ValueError("Invalid chrono program number")
+        self.version = "%08x" % zlib.crc32(json.dumps(self.asDict(), separators=(",", ":")).encode("ascii"))
+
+    @classmethod
+    def fromData(cls, data):
+        """Chrono of the data of a GET CHRD reply ("Programs" and "Days"), None if there is none"""
+        programs = data.get("Programs")
+        days = data.get("Days")
+        if not isinstance(programs, dict) or not isinstance(days, dict):
+            return None
+        try:
+            return cls([(p["START"], p["STOP"], p["SETP"]) for p in (programs["P"+str(i + 1)] for i in range(CHRONO_PROGRAMS))],
+                       [[parseProgram(d["M"+str(j + 1)]) for j in range(CHRONO_SLOTS)] for d in (days["D"+str(i + 1)] for i in range(CHRONO_DAYS))])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @classmethod
+    def fromDict(cls, value):
+        """Chrono of asDict(), raises ValueError if it is not valid"""
+        try:
+            return cls(value["programs"], value["days"])
+        except (KeyError, TypeError) as e:
+            raise ValueError("Invalid chrono: "+str(e))
+
+    def asDict(self):
+        return { "programs": self.programs, "days": self.days }
+
+    def __eq__(self, other):
+        return isinstance(other, Chrono) and self.version == other.version and self.asDict() == other.asDict()
+
+    def edited(self, changes):
+        """Copy with changes, named like the elements of the replies of the box:
+        Pn: "start,stop,setpoint" (e.g. "06:30,08:30,21"), Dn: "program,program,program" (program number, P1 or OFF).
+        Raises ValueError on a bad change"""
+        programs = [list(program) for program in self.programs]
+        days = [list(slots) for slots in self.days]
+        for name, value in changes.items():
+            kind, index = name[:1].upper(), name[1:]
+            index = int(index) - 1 if index.isdigit() else -1
+            values = [item.strip() for item in str(value).split(",")]
+            if kind == "P" and 0 <= index < CHRONO_PROGRAMS and len(values) == 3:
+                programs[index] = [values[0], values[1], int(values[2])]
+            elif kind == "D" and 0 <= index < CHRONO_DAYS and len(values) == CHRONO_SLOTS:
+                days[index] = [parseProgram(item) for item in values]
+            else:
+                raise ValueError("Invalid chrono change: %s=%s" % (name, value))
+        return Chrono(programs, days)
+
+    def diff(self, target):
+        """Commands turning this program into target: one per changed program and per changed day slot"""
+        commands = []
+        for i, (program, wanted) in enumerate(zip(self.programs, target.programs)):
+            if program != wanted:
+                commands.append(chronoProgramCommand(i + 1, *wanted))
+        for i, (slots, wanted) in enumerate(zip(self.days, target.days)):
+            for j, (program, wantedProgram) in enumerate(zip(slots, wanted)):
+                if program != wantedProgram:
+                    commands.append(chronoDayCommand(i + 1, j + 1, wantedProgram))
+        return commands
+
+    def applied(self, command):
+        """Copy with a chrono command applied, None if it is not a chrono command"""
+        name = commandName(command)
+        args = command.split("+")[2:]
+        try:
+            if name == "SET+CPRD" and len(args) == 6:
+                program, setpoint, startHour, startMinute, stopHour, stopMinute = map(int, args)
+                programs = [list(p) for p in self.programs]
+                programs[program - 1] = ["%02d:%02d" % (startHour, startMinute), "%02d:%02d" % (stopHour, stopMinute), setpoint]
+                return Chrono(programs, self.days)
+            if name == "SET+CDAY" and len(args) == 3:
+                day, slot, program = map(int, args)
+                days = [list(slots) for slots in self.days]
+                days[day - 1][slot - 1] = program
+                return Chrono(self.programs, days)
+        except (ValueError, IndexError):
+            pass
+        return None
+
+def parseProgram(value):
+    """Program number of a day slot: "P1" to "P6", "OFF" (0), or a number"""
+    value = str(value).strip().upper()
+    if value == "OFF":
+        return 0
+    return int(value[1:] if value.startswith("P") else value)
+
+
+class ClientError(Exception):
+    """HTTP error, malformed reply or error reply of a Connection Box"""
+
+
+class ConnectionDropped(ConnectionResetError):
+    """Connection closed by the box before the first byte of the reply"""
+
+
+class Client:
+    """asyncio client of a Connection Box.
+
+    Requests are sent on pooled keep-alive connections: at most `connections` requests are in flight at once, and
+    a connection closed by the box while idle is replaced transparently (a GET request is sent again on a new
+    connection, never a command that changes the stove, nor a request that timed out). Replies to polls and commands update
+    `state`, the replies of the box being authoritative.
+    """
+
+    def __init__(self, host, port = 80, api = "lua", timeout = 10, connections = 2):
+        self.host = host
+        self.port = int(port)
+        self.api = api
+        self.uri = API_URIS[api]
+        self.timeout = timeout
+        self.connections = connections
+        self.decoder = ResponseDecoder(api)
+        self.state = StoveState()
+        # idle keep-alive connections: (reader, writer)
+        self.idle = []
+        # created in the event loop of the first request
+        self.slots = None
+        self.requests = 0
+        self.connects = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Close the idle connections"""
+        idle, self.idle = self.idle, []
+        for reader, writer in idle:
+            writer.close()
+
+    async def request(self, command):
+        """Reply of the box to a command (e.g. GET+ALLS), as a dict. Raises ClientError, OSError or asyncio.TimeoutError"""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.connections)
+        async with self.slots:
+            while True:
+                reader = writer = None
+                while self.idle:
+                    reader, writer = self.idle.pop()
+                    if not reader.at_eof():
+                        break
+                    # closed by the box while idle
+                    writer.close()
+                    reader = writer = None
+                reused = reader is not None
+                if not reused:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+                    self.connects += 1
+                try:
+                    status, body, keepAlive = await asyncio.wait_for(self.exchange(reader, writer, command), self.timeout)
+                except ConnectionDropped:
+                    writer.close()
+                    if reused and command.startswith("GET+"):
+                        # closed by the box while idle, nothing was read: retry on a new connection
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                break
+            if keepAlive:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+        self.requests += 1
+
+        if status != 200:
+            raise ClientError("HTTP status %d in reply to %s" % (status, command))
+        reply = parseReply(body)
+        if reply is None:
+            raise ClientError("Malformed reply to "+command)
+        if not self.decoder.isOK(reply):
+            raise ClientError("Error reply to %s: %s" % (command, reply.get(self.decoder.infoKey)))
+        return reply
+
+    async def exchange(self, reader, writer, command):
+        """Send one HTTP request, returns (status, body, keep-alive)"""
+        try:
+            writer.write(("GET %s?cmd=%s HTTP/1.1\r\nHost: %s\r\nConnection: keep-alive\r\n\r\n" %
+                          (self.uri, command, self.host)).encode("ascii"))
+            await writer.drain()
+            line = await reader.readline()
+        except (ConnectionResetError, BrokenPipeError) as e:
+            raise ConnectionDropped(str(e))
+        if not line:
+            raise ConnectionDropped("Connection closed by the box")
+        parts = line.decode("latin-1").split(None, 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ClientError("Malformed HTTP status line: "+repr(line))
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, sep, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        keepAlive = parts[0] != "HTTP/1.0" and headers.get("connection", "").lower() != "close"
+
+        if "content-length" in headers or "chunked" in headers.get("transfer-encoding", "").lower():
+            # the box does not pipeline: what follows the headers is this body only
+            assembler = BodyAssembler()
+            body = assembler.feed(b"", headers)
+            while body is None:
+                data = await reader.read(65536)
+                if not data:
+                    raise asyncio.IncompleteReadError(bytes(assembler.buffer), None)
+                body = assembler.feed(data)
+            body = bytes(body)
+        else:
+            body = await reader.read()
+            keepAlive = False
+        return int(parts[1]), body, keepAlive
+
+    async def command(self, command):
+        """Send a command, the data of its reply updates the state, returns the state"""
+        reply = await self.request(command)
+        tag, data = self.decoder.payload(reply)
+        if data:
+            self.state.update(self.decoder.decode(data))
+        return self.state
+
+    async def poll(self):
+        """Read all the data of the box (GET ALLS, and GET CHRD for the chrono status with the PHP API), returns the state"""
+        await self.command("GET+ALLS")
+        if self.api == "php":
+            await self.command("GET+CHRD")
+        return self.state
+
+    async def switch(self, on):
+        return await self.command(switchCommand(on))
+
+    async def setSetpoint(self, setpoint):
+        return await self.command(setpointCommand(setpoint))
+
+    async def setFanLevel(self, fanLevel):
+        return await self.command(fanCommand(fanLevel))
+
+    async def setPower(self, power):
+        return await self.command(powerCommand(power))
+
+    async def setChrono(self, on):
+        return await self.command(chronoCommand(on))
+
+    async def readChrono(self):
+        """Weekly chrono program of the stove (GET CHRD)"""
+        reply = await self.request("GET+CHRD")
+        tag, data = self.decoder.payload(reply)
+        chrono = Chrono.fromData(data) if data else None
+        if chrono is None:
+            raise ClientError("No chrono program in the reply to GET+CHRD")
+        return chrono
+
+    async def writeChrono(self, chrono, current = None):
+        """Upload a weekly chrono program, sending only the changes from current (read from the box if None).
+        Returns the commands sent"""
+        if current is None:
+            current = await self.readChrono()
+        commands = current.diff(chrono)
+        for command in commands:
+            await self.request(command)
+        return commands
+
+
+async def pollMany(clients):
+    """Poll several boxes concurrently, returns their states in the order of clients; the state of a box that
+    could not be polled is replaced by the exception raised"""
+    return await asyncio.gather(*(client.poll() for client in clients), return_exceptions=True)
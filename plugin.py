@@ -5,16 +5,22 @@
 # Changes:
 # 20181114 - New Plugin option to choose the Connection Box API.
 #            Staring mid-2018, Palazzetti has released a new software and the API URLs changes from PHP to LUA.
+# 20261018 - Several Connection Boxes can be managed by a single hardware entry (comma separated addresses).
+#            The Connection Box protocol and an asyncio client are in palazzetti.py, usable without Domoticz.
+#            The Connection Box API is detected automatically by default, and cached in the plugin folder.
+#            The state of the boxes is saved at stop, and resumed at the next start.
 #
 """
-<plugin key="palazzetti-cbox" name="Palazzetti Connection Box" author="kinou74" version="0.9.1">
+<plugin key="palazzetti-cbox" name="Palazzetti Connection Box" author="kinou74" version="0.10.0">
     <params>
-        <param field="Address" label="Connection Box IP Address" width="200px" required="true" default="127.0.0.1"/>
-        <param field="Port" label="Port" width="30px" required="true" default="80"/>
-        <param field="Mode4" label="Use new Connection Box LUA API" width="75px">
+        <param field="Address" label="Connection Box IP Address(es)" width="300px" required="true" default="127.0.0.1"/>
+        <param field="Port" label="Default Port" width="30px" required="true" default="80"/>
+        <param field="Mode3" label="Advanced Options" width="500px" default="" />
+        <param field="Mode4" label="Connection Box API" width="100px">
             <options>
-                <option label="True (default)" value="True" default="true" />
-                <option label="False" value="False" />
+                <option label="Auto (default)" value="Auto" default="true" />
+                <option label="LUA (new)" value="True" />
+                <option label="PHP (old)" value="False" />
             </options>
         </param>
         <param field="Mode5" label="Custom Codes" width="500px" default="" />
@@ -30,11 +36,1187 @@
 import Domoticz
 import json
 import ast
+import time
+import random
+import os
+import mmap
+import struct
+import threading
+import csv
+import io
+from collections import OrderedDict, deque
+from bisect import bisect_left
+from urllib.parse import unquote_plus
+from palazzetti import (API_URIS, STATUS_CODES, ALARM_CODES, TRANSITIONAL_STATUS, ALARM_STATUS, STATUS_OFF, BURNING_STATUS,
+                        STATUS_NOPELLET, FAN_AUTO, FAN_HI, FAN_OFF, isRunning, statusLabel, commandFamily,
+                        switchCommand, setpointCommand, fanCommand, powerCommand, chronoCommand, parseReply, ResponseDecoder,
+                        Chrono, commandName, INDEXED_COMMANDS, FIELDS, StoveState, BodyAssembler, checkCommand)
+
+# Each Connection Box owns a range of UNITS_PER_BOX Domoticz units: box #1 uses units 1 to 49 (as before),
+# box #2 units 51 to 99, etc. Domoticz units are limited to 255, hence MAX_BOXES.
+UNITS_PER_BOX = 50
+MAX_BOXES = 5
+
+# Heartbeat interval, in seconds: the poll scheduler cannot be faster than this
+HEARTBEAT = 2
+
+# Consecutive replies not matching the API of a box after which the other API is probed
+API_MISMATCHES = 3
+
+class Worker:
+    """Background thread for the work the callbacks do not have to wait for: file writes (history, pellets, chrono),
+    exports and log output, so that the callback latency does not depend on them.
+
+    The queue is bounded. A job submitted with a key replaces the pending job of the same key, keeping its place
+    (e.g. only the last state of the pellet estimator is worth saving); when the queue is full, new jobs are dropped.
+    Without a running thread (before onStart, after onStop), jobs are run at once.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.jobs = OrderedDict()  # key -> (function, args)
+        self.ready = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.sequence = 0          # keys of the jobs submitted without a key
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self, size):
+        self.size = size
+        if self.thread is None:
+            self.stopping = False
+            self.thread = threading.Thread(target=self.run, name="palazzetti-worker", daemon=True)
+            self.thread.start()
+
+    def submit(self, key, function, *args):
+        """Queue function(*args), returns False if the job was dropped"""
+        if self.thread is None:
+            self.execute(function, args)
+            return True
+        with self.ready:
+            self.submitted += 1
+            if key is not None and key in self.jobs:
+                self.jobs[key] = (function, args)
+                self.coalesced += 1
+                return True
+            if len(self.jobs) >= self.size:
+                self.dropped += 1
+                return False
+            if key is None:
+                self.sequence += 1
+                key = self.sequence
+            self.jobs[key] = (function, args)
+            self.ready.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.jobs and not self.stopping:
+                    self.ready.wait()
+                if not self.jobs:
+                    return
+                key, (function, args) = self.jobs.popitem(last=False)
+            self.execute(function, args)
+
+    def execute(self, function, args):
+        try:
+            function(*args)
+        except Exception as e:
+            self.failed += 1
+            Domoticz.Error("Background job "+getattr(function, "__name__", "")+" failed: "+str(e))
+
+    def stop(self, timeout):
+        """Run the pending jobs and stop the thread, returns False if they did not complete in time"""
+        thread = self.thread
+        if thread is None:
+            return True
+        with self.ready:
+            self.stopping = True
+            self.ready.notify()
+        thread.join(timeout)
+        self.thread = None
+        return not thread.is_alive()
+
+# Background work of the plugin
+worker = Worker(256)
+
+class TraceLog:
+    """Debug log formatted only when debugging, and ring buffer of the last events (commands sent, replies,
+    state changes), logged when something goes wrong: the context of an error is there even in Normal mode.
+
+    Messages are %-format strings with their arguments: events are stored unformatted, and formatted by the
+    worker thread, so the arguments must not be changed once logged (log a dict when it is final, or a copy).
+    """
+
+    def __init__(self, size):
+        self.debugging = False
+        self.resize(size)
+
+    def resize(self, size):
+        self.size = size
+        self.events = [None] * size  # (time.time(), format, args)
+        self.next = 0
+        self.dumped = 0  # number of events recorded at the last dump
+        self.recorded = 0
+
+    def debug(self, message, *args):
+        if self.debugging:
+            worker.submit(None, self.writeDebug, message, args)
+
+    def event(self, message, *args):
+        if self.size > 0:
+            self.events[self.next] = (time.time(), message, args)
+            self.next = (self.next + 1) % self.size
+            self.recorded += 1
+        if self.debugging:
+            worker.submit(None, self.writeDebug, message, args)
+
+    def writeDebug(self, message, args):
+        Domoticz.Debug(message % args if args else message)
+
+    def error(self, message, *args):
+        Domoticz.Error(message % args if args else message)
+        self.dump("error")
+
+    def dump(self, reason):
+        """Log the events recorded since the previous dump (Debug mode already shows them)"""
+        count = min(self.recorded - self.dumped, self.size)
+        self.dumped = self.recorded
+        if count == 0 or self.debugging:
+            return
+        worker.submit(None, self.writeEvents, reason, [self.events[i % self.size] for i in range(self.next - count, self.next)])
+
+    def writeEvents(self, reason, events):
+        Domoticz.Log("Last "+str(len(events))+" events before "+reason+":")
+        for timestamp, message, args in events:
+            Domoticz.Log("  "+time.strftime("%H:%M:%S", time.localtime(timestamp))+("%.3f" % (timestamp % 1))[1:]+" "+
+                         (message % args if args else message))
+
+# Log of the plugin
+log = TraceLog(0)
+
+class PollScheduler:
+    """Decides when a box has to be polled again, according to the stove status and the recent commands"""
+
+    def __init__(self, fastInterval, normalInterval, idleInterval, fastWindow, idleDelay):
+        self.fastInterval = fastInterval
+        self.normalInterval = normalInterval
+        self.idleInterval = idleInterval
+        self.fastWindow = fastWindow
+        self.idleDelay = idleDelay
+
+        self.nextPoll = 0
+        self.fastUntil = 0
+        self.alarmUntil = 0  # end of the fast polling that follows a new alarm
+        self.status = -1
+        self.offSince = None
+
+    def start(self, now, delay):
+        self.nextPoll = now + delay
+
+    def interval(self, now):
+        if now < self.fastUntil or now < self.alarmUntil or self.status in TRANSITIONAL_STATUS:
+            return self.fastInterval
+        if self.offSince is not None and now - self.offSince >= self.idleDelay:
+            return self.idleInterval
+        return self.normalInterval
+
+    def isDue(self, now):
+        return now >= self.nextPoll
+
+    def polled(self, now):
+        self.nextPoll = now + self.interval(now)
+
+    def commandSent(self, now):
+        # poll fast for a while to get the confirmation of the command
+        self.fastUntil = now + self.fastWindow
+        self.nextPoll = min(self.nextPoll, now + self.fastInterval)
+
+    def commandApplied(self, now, pollFast):
+        """The reply of a command told its effect: no need to poll for it at once"""
+        if not pollFast:
+            self.fastUntil = now
+        self.nextPoll = now + self.interval(now)
+
+    def statusUpdated(self, status, now):
+        if status == STATUS_OFF:
+            if self.offSince is None:
+                self.offSince = now
+        else:
+            self.offSince = None
+
+        if status != self.status:
+            if status >= ALARM_STATUS:
+                # the first minutes of an alarm are worth following, not the whole night of a NOPELLET
+                self.alarmUntil = now + self.fastWindow
+            self.status = status
+            # e.g. entering HEATUP: do not wait for the end of a normal/idle interval
+            self.nextPoll = min(self.nextPoll, now + self.interval(now))
+
+    def save(self, now, wall):
+        # in wall clock time (time.time()), the monotonic clock starts again with the system
+        return { "nextPoll": self.nextPoll - now + wall, "fastUntil": self.fastUntil - now + wall,
+                 "alarmUntil": self.alarmUntil - now + wall, "status": self.status,
+                 "offSince": None if self.offSince is None else self.offSince - now + wall }
+
+    def load(self, saved, now, wall):
+        # a poll missed while the plugin was stopped is due at once
+        self.nextPoll = max(now, min(saved["nextPoll"] - wall + now, now + self.idleInterval))
+        self.fastUntil = saved["fastUntil"] - wall + now
+        self.alarmUntil = saved["alarmUntil"] - wall + now
+        self.status = saved["status"]
+        self.offSince = None if saved["offSince"] is None else saved["offSince"] - wall + now
+
+class CommandQueue:
+    """Pending commands of a box, coalesced by command family (last write wins).
+
+    User commands have priority over polls. A user command is held for 'debounce' seconds (and until 'debounce'
+    seconds after the last command of its family), so that a burst of slider moves ends up in a single request.
+    A held command does not delay the commands of other families queued after it.
+    A user command not sent within 'timeout' seconds (e.g. the box is not reachable) expires.
+    """
+
+    def __init__(self, debounce, timeout):
+        self.debounce = debounce
+        self.timeout = timeout
+        self.userLane = OrderedDict()  # family -> [command, readyAt, deadline]
+        self.pollLane = OrderedDict()
+        self.lastSent = {}  # family -> time
+
+    def __len__(self):
+        return len(self.userLane) + len(self.pollLane)
+
+    def push(self, command, prio, now, delay = 0, timeout = None):
+        """Queue a command: a user command expires 'timeout' seconds from now (default: the timeout of the queue)"""
+        family = commandFamily(command)
+        deadline = now + (self.timeout if timeout is None else timeout)
+        lane = self.userLane if prio else self.pollLane
+
+        entry = lane.get(family)
+        if entry is not None:
+            # replace the pending value, keeping its place in the queue
+            entry[0] = command
+            if prio:
+                entry[2] = deadline
+            return
+
+        readyAt = now + delay
+        if prio:
+            # the first value of a burst waits for the next ones too
+            readyAt = max(readyAt, now + self.debounce)
+            lastSent = self.lastSent.get(family)
+            if lastSent is not None:
+                readyAt = max(readyAt, lastSent + self.debounce)
+        lane[family] = [command, readyAt, deadline]
+
+    def pop(self, now):
+        """First command ready to be sent, in queue order, or None"""
+        for lane in (self.userLane, self.pollLane):
+            for family, entry in lane.items():
+                if entry[1] <= now:
+                    del lane[family]
+                    self.lastSent[family] = now
+                    return entry[0]
+        return None
+
+    def expire(self, now):
+        """Withdraw the user commands that were not sent in time, returns them"""
+        expired = [family for family, entry in self.userLane.items() if entry[2] <= now]
+        return [self.userLane.pop(family)[0] for family in expired]
+
+    def commands(self):
+        return [entry[0] for lane in (self.userLane, self.pollLane) for entry in lane.values()]
+
+    def userCommands(self):
+        """(command, deadline) of the pending user commands"""
+        return [(entry[0], entry[2]) for entry in self.userLane.values()]
+
+class DeviceCache:
+    """Shadow of the values last written to the Domoticz devices.
+
+    Updates are staged while a message is processed and flushed at the end with a single Update per changed
+    device: staging a value equal to the shadow costs neither a Domoticz API call nor a database write.
+    """
+
+    def __init__(self):
+        self.values = {}   # unit -> (nValue, sValue)
+        self.pending = {}  # unit -> (nValue, sValue)
+        self.applied = 0
+        self.skipped = 0
+
+    def load(self):
+        # one read of every device, at startup
+        self.values = {}
+        for unit in Devices:
+            self.values[unit] = (Devices[unit].nValue, Devices[unit].sValue)
+
+    def stage(self, unit, nValue, sValue):
+        value = (nValue, str(sValue))
+        if unit not in self.pending and self.values.get(unit) == value:
+            self.skipped += 1
+            return
+        self.pending[unit] = value
+
+    def unstage(self, unit):
+        """Withdraw the value staged for a unit, returns it (None if there is none)"""
+        return self.pending.pop(unit, None)
+
+    def flush(self, debug = False):
+        for unit, value in self.pending.items():
+            if self.values.get(unit) == value:
+                self.skipped += 1
+            # Make sure that the Domoticz device still exists (they can be deleted) before updating it 
+            elif unit in Devices:
+                Devices[unit].Update(nValue=value[0], sValue=value[1])
+                self.values[unit] = value
+                self.applied += 1
+                if debug:
+                    Domoticz.Debug("Update "+str(value[0])+":'"+value[1]+"' ("+Devices[unit].Name+")")
+            else:
+                self.values.pop(unit, None)
+        self.pending.clear()
+
+class Request:
+    """A request sent to a box"""
+    __slots__ = ("seq", "command", "tags", "sentAt", "deadline", "attempt")
+
+    def __init__(self, seq, command, tags, sentAt, deadline, attempt):
+        self.seq = seq
+        self.command = command
+        self.tags = tags
+        self.sentAt = sentAt
+        self.deadline = deadline
+        self.attempt = attempt
+
+class InFlightWindow:
+    """Requests sent to a box and not answered yet, in sending order.
+
+    A keep-alive HTTP/1.1 connection answers the requests in order: a reply matches the oldest request it can
+    answer, the older ones will never be answered.
+    """
+
+    def __init__(self, maxInFlight, timeout):
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.requests = deque()
+        self.seq = 0
+
+        # statistics
+        self.lastRtt = None
+        self.rtt = None       # moving average, in seconds
+        self.answered = 0
+        self.timeouts = 0
+        self.unexpected = 0   # replies matching no request (stale or duplicate)
+        self.rttHistogram = None  # Histogram, when the metrics are enabled
+
+    def __len__(self):
+        return len(self.requests)
+
+    def isFull(self):
+        return len(self.requests) >= self.maxInFlight
+
+    def sent(self, command, tags, now, attempt):
+        self.seq += 1
+        request = Request(self.seq, command, tags, now, now + self.timeout, attempt)
+        self.requests.append(request)
+        return request
+
+    def match(self, tag, now):
+        """(request answered, [older requests that will not be answered]), request is None if the reply matches none"""
+        requests = self.requests
+        for i in range(len(requests)):
+            if tag is None or tag in requests[i].tags:
+                lost = [requests.popleft() for j in range(i)]
+                request = requests.popleft()
+
+                self.answered += 1
+                self.lastRtt = now - request.sentAt
+                self.rtt = self.lastRtt if self.rtt is None else 0.8 * self.rtt + 0.2 * self.lastRtt
+                if self.rttHistogram is not None:
+                    self.rttHistogram.add(self.lastRtt)
+                return request, lost
+
+        self.unexpected += 1
+        return None, []
+
+    def has(self, command):
+        for request in self.requests:
+            if request.command == command:
+                return True
+        return False
+
+    def expired(self, now):
+        return len(self.requests) > 0 and self.requests[0].deadline <= now
+
+    def clear(self):
+        requests = list(self.requests)
+        self.requests.clear()
+        return requests
+
+# States of the connection to a box
+LINK_DISCONNECTED = "disconnected"
+LINK_CONNECTING = "connecting"
+LINK_CONNECTED = "connected"
+LINK_BACKING_OFF = "backing-off"
+
+class BoxLink:
+    """Lifecycle of the connection to a box.
+
+    disconnected -> connecting -> connected -> disconnected (closed by either side)
+    A failure (connection refused, request timeout) leads to backing-off: the next connection attempt waits for
+    an exponential delay with jitter, so that a rebooting box is not hammered with connection attempts.
+    """
+
+    def __init__(self, conn, backoffMin, backoffMax):
+        self.conn = conn
+        self.backoffMin = backoffMin
+        self.backoffMax = backoffMax
+        self.state = LINK_DISCONNECTED
+        self.failures = 0
+        self.retryAt = 0
+        self.lastActivity = 0
+        self.closing = False
+        self.connects = 0
+        self.reconnects = 0     # connections opened again after a failure or a connection dropped by the box
+        self.recovering = False
+
+    def isConnected(self):
+        return self.state == LINK_CONNECTED
+
+    def connect(self, now):
+        """Connect, unless already connected/connecting or backing-off. Returns True if an attempt was started"""
+        if self.state == LINK_CONNECTED or self.state == LINK_CONNECTING:
+            return False
+        if self.state == LINK_BACKING_OFF and now < self.retryAt:
+            return False
+        self.state = LINK_CONNECTING
+        self.conn.Connect()
+        return True
+
+    def close(self):
+        """Close on purpose (e.g. idle connection): not a failure"""
+        if self.state == LINK_CONNECTED or self.state == LINK_CONNECTING:
+            self.closing = True
+            self.conn.Disconnect()
+
+    def fail(self, now):
+        """The box did not answer: close the connection and wait before the next attempt"""
+        self.failures += 1
+        self.recovering = True
+        delay = min(self.backoffMax, self.backoffMin * (2 ** (self.failures - 1)))
+        self.retryAt = now + random.uniform(delay / 2, delay)
+        self.state = LINK_BACKING_OFF
+        if self.conn.Connected() or self.conn.Connecting():
+            self.conn.Disconnect()
+
+    def onConnected(self, now):
+        # accepting the connection does not make the box healthy (e.g. rebooting): failures are reset by replied()
+        self.state = LINK_CONNECTED
+        self.closing = False
+        self.lastActivity = now
+        self.connects += 1
+        if self.recovering:
+            self.reconnects += 1
+            self.recovering = False
+
+    def replied(self):
+        """A valid reply was received: the next failure backs off from backoffMin again"""
+        self.failures = 0
+
+    def onDisconnected(self):
+        if self.state != LINK_BACKING_OFF:
+            self.state = LINK_DISCONNECTED
+            if not self.closing:
+                self.recovering = True
+        self.closing = False
+
+    def activity(self, now):
+        self.lastActivity = now
+
+    def idleFor(self, now):
+        return now - self.lastActivity
+
+# Metrics recorded in the telemetry history, as decoded fields
+HISTORY_METRICS = ("TMP_ROOM", "TMP_PELLET_BACKW", "TMP_EXHAUST", "STATUS", "POWER", "FAN_FAN2LEVEL", "PELLET_QTUSED")
+NAN = float("nan")
+HISTORY_INDEX = dict((field, i) for i, field in enumerate(HISTORY_METRICS))
+
+class HistoryRing:
+    """Fixed-size ring of rows (timestamp, width float values) stored in a region of a memory-mapped file.
+
+    Region layout: head (index of the next row) and count as uint32, then capacity uint32 timestamps,
+    then capacity rows of width float32.
+    """
+
+    def __init__(self, buffer, offset, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.header = buffer[offset:offset + 8].cast("I")
+        offset += 8
+        self.timestamps = buffer[offset:offset + 4 * capacity].cast("I")
+        offset += 4 * capacity
+        self.values = buffer[offset:offset + 4 * capacity * width].cast("f")
+
+    @staticmethod
+    def size(capacity, width):
+        return 8 + 4 * capacity + 4 * capacity * width
+
+    def __len__(self):
+        return self.header[1]
+
+    def append(self, timestamp, row):
+        head = self.header[0]
+        self.write(head, timestamp, row)
+        self.header[0] = (head + 1) % self.capacity
+        if self.header[1] < self.capacity:
+            self.header[1] += 1
+
+    def overwriteLast(self, timestamp, row):
+        self.write((self.header[0] - 1) % self.capacity, timestamp, row)
+
+    def write(self, index, timestamp, row):
+        self.timestamps[index] = timestamp
+        values = self.values
+        base = index * self.width
+        for i in range(self.width):
+            values[base + i] = row[i]
+
+    def last(self):
+        """Values of the last row"""
+        base = ((self.header[0] - 1) % self.capacity) * self.width
+        return self.values[base:base + self.width]
+
+    def indexes(self, start, end):
+        """Indexes of the rows with start <= timestamp < end, oldest first"""
+        head, count = self.header[0], self.header[1]
+        for i in range(head - count, head):
+            index = i % self.capacity
+            if start <= self.timestamps[index] < end:
+                yield index
+
+    def release(self):
+        self.header.release()
+        self.timestamps.release()
+        self.values.release()
+
+class TelemetryHistory:
+    """Minute-level history of some metrics of a box, with hourly and daily min/max/avg rollups.
+
+    Everything lives in a memory-mapped file: writes are O(1) stores into preallocated arrays, and the history
+    (including the rollups in progress) is there again after a plugin reload. Hours and days are UTC.
+    """
+
+    MAGIC = b"PLZH"
+    VERSION = 1
+    HEADER = struct.Struct("<4sIIIII")  # magic, version, width, minute/hour/day capacities
+    HEADER_SIZE = 32
+
+    def __init__(self, path, metrics, minutes, hours, days):
+        self.path = path
+        self.metrics = metrics
+        self.width = width = len(metrics)
+        layout = (self.MAGIC, self.VERSION, width, minutes, hours, days)
+
+        size = self.HEADER_SIZE + 4 * 4 + 8 * 4 * width * 2
+        size += HistoryRing.size(minutes, width) + HistoryRing.size(hours, 3 * width) + HistoryRing.size(days, 3 * width)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        if not fresh and self.HEADER.unpack_from(self.mm, 0) != layout:
+            fresh = True
+            self.mm[:] = bytes(size)
+        if fresh:
+            self.HEADER.pack_into(self.mm, 0, *layout)
+
+        buffer = memoryview(self.mm)
+        offset = self.HEADER_SIZE
+        # last minute, hour and day started, as timestamps
+        self.state = buffer[offset:offset + 16].cast("I")
+        offset += 16
+        # min, max, sum, count of each metric, for the hour and the day in progress
+        self.hourAcc = buffer[offset:offset + 32 * width].cast("d")
+        offset += 32 * width
+        self.dayAcc = buffer[offset:offset + 32 * width].cast("d")
+        offset += 32 * width
+        self.minutes = HistoryRing(buffer, offset, minutes, width)
+        offset += HistoryRing.size(minutes, width)
+        self.hours = HistoryRing(buffer, offset, hours, 3 * width)
+        offset += HistoryRing.size(hours, 3 * width)
+        self.days = HistoryRing(buffer, offset, days, 3 * width)
+        buffer.release()
+
+        if fresh:
+            self.resetAcc(self.hourAcc)
+            self.resetAcc(self.dayAcc)
+
+    def resetAcc(self, acc):
+        for i in range(self.width):
+            acc[4 * i] = NAN
+            acc[4 * i + 1] = NAN
+            acc[4 * i + 2] = 0.0
+            acc[4 * i + 3] = 0.0
+
+    def fold(self, acc, row):
+        for i in range(self.width):
+            value = row[i]
+            if value == value:  # not NaN
+                j = 4 * i
+                if not acc[j] <= value:
+                    acc[j] = value
+                if not acc[j + 1] >= value:
+                    acc[j + 1] = value
+                acc[j + 2] += value
+                acc[j + 3] += 1
+
+    def emit(self, ring, timestamp, acc):
+        row = []
+        for i in range(self.width):
+            j = 4 * i
+            row.extend((acc[j], acc[j + 1], acc[j + 2] / acc[j + 3] if acc[j + 3] > 0 else NAN))
+        ring.append(timestamp, row)
+        self.resetAcc(acc)
+
+    def sample(self, now, row):
+        """Record the current values (a sequence of floats, NaN if unknown), at most one row per minute"""
+        minute = int(now) // 60 * 60
+        state = self.state
+        if minute == state[0]:
+            # the last value of a minute wins
+            self.minutes.overwriteLast(minute, row)
+            return
+        if minute < state[0]:
+            # clock going backwards
+            return
+
+        # the previous minute is complete: roll it up
+        if state[0] != 0:
+            last = self.minutes.last()
+            self.fold(self.hourAcc, last)
+            self.fold(self.dayAcc, last)
+            last.release()
+
+        hour = minute // 3600 * 3600
+        if hour != state[1]:
+            if state[1] != 0:
+                self.emit(self.hours, state[1], self.hourAcc)
+            state[1] = hour
+
+        day = minute // 86400 * 86400
+        if day != state[2]:
+            if state[2] != 0:
+                self.emit(self.days, state[2], self.dayAcc)
+            state[2] = day
+
+        self.minutes.append(minute, row)
+        state[0] = minute
+
+    def query(self, metric, start = 0, end = 2 ** 32, resolution = "minute"):
+        """History of a metric between two timestamps.
+        resolution "minute": [(timestamp, value)], "hour" or "day": [(timestamp, min, max, avg)]"""
+        i = self.metrics.index(metric)
+        if resolution == "minute":
+            ring = self.minutes
+            return [(ring.timestamps[index], ring.values[index * ring.width + i]) for index in ring.indexes(start, end)]
+        ring = self.hours if resolution == "hour" else self.days
+        base = 3 * i
+        return [(ring.timestamps[index],) + tuple(ring.values[index * ring.width + base:index * ring.width + base + 3])
+                for index in ring.indexes(start, end)]
+
+    def close(self):
+        for view in (self.state, self.hourAcc, self.dayAcc):
+            view.release()
+        for ring in (self.minutes, self.hours, self.days):
+            ring.release()
+        self.mm.flush()
+        self.mm.close()
+
+class TelemetryExporter:
+    """Export of the raw poll payloads of a box (every key, not only the decoded fields) to a local file, in InfluxDB
+    line protocol or CSV, for a time-series database.
+
+    The callbacks only keep (timestamp, payload) in a buffer. The worker formats a batch and appends it to the file
+    with a single write. The file is rotated when it would exceed maxBytes: export-1.lp becomes export-1.lp.1, etc.,
+    and only the keep most recent rotated files are kept.
+    Numbers are written as floats, so that a value like 20 then 20.5 does not change the type of an InfluxDB field.
+    CSV files have a column per key of their first sample.
+    """
+
+    EXTENSIONS = { "influx": ".lp", "csv": ".csv" }
+
+    def __init__(self, path, format, box, maxBytes, keep):
+        self.format = format
+        self.path = path + self.EXTENSIONS[format]
+        self.box = box
+        self.prefix = "palazzetti,box=" + self.escape(box) + " "
+        self.maxBytes = maxBytes
+        self.keep = keep
+        self.buffer = []
+        self.columns = None  # CSV columns of the current file
+        self.samples = 0
+        self.batches = 0
+
+    def add(self, timestamp, data):
+        self.buffer.append((timestamp, data))
+        self.samples += 1
+
+    def take(self):
+        """Buffered samples, to be given to write()"""
+        batch, self.buffer = self.buffer, []
+        return batch
+
+    @staticmethod
+    def escape(name):
+        return str(name).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+    @staticmethod
+    def flatten(data, prefix = ""):
+        """(key, scalar value) of a payload: FANLMINMAX [0, 6] gives FANLMINMAX_0 and FANLMINMAX_1"""
+        for key, value in data.items() if isinstance(data, dict) else enumerate(data):
+            key = prefix + str(key)
+            if isinstance(value, (dict, list, tuple)):
+                yield from TelemetryExporter.flatten(value, key + "_")
+            elif value is not None:
+                yield key, value
+
+    @staticmethod
+    def influxValue(value):
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, (int, float)):
+            return repr(float(value))
+        return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    def formatInflux(self, batch):
+        lines = []
+        lastData = lastFields = None
+        for timestamp, data in batch:
+            if data is not lastData:
+                # consecutive unchanged polls share their payload
+                lastData = data
+                lastFields = ",".join(self.escape(key) + "=" + self.influxValue(value) for key, value in self.flatten(data))
+            if lastFields:
+                lines.append("%s%s %d000000000\n" % (self.prefix, lastFields, timestamp))
+        return "".join(lines)
+
+    def formatCSV(self, batch, header):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        if header:
+            writer.writerow(self.columns)
+        keys = self.columns[2:]
+        for timestamp, data in batch:
+            values = dict(self.flatten(data))
+            writer.writerow([int(timestamp), self.box] + [values.get(key, "") for key in keys])
+        return out.getvalue()
+
+    def write(self, batch):
+        # in the worker thread
+        try:
+            size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            size = 0
+        if size > 0 and self.format == "csv" and self.columns is None:
+            with open(self.path, newline="") as f:
+                self.columns = next(csv.reader(f), None)
+
+        if self.format == "influx":
+            data = self.formatInflux(batch).encode("utf-8")
+        else:
+            header = size == 0 or self.columns is None
+            if header:
+                self.columns = ["time", "box"] + sorted(key for key, value in self.flatten(batch[0][1]))
+            data = self.formatCSV(batch, header).encode("utf-8")
+
+        if size > 0 and size + len(data) > self.maxBytes:
+            self.rotate()
+            if self.format == "csv":
+                self.columns = None
+                return self.write(batch)
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        self.batches += 1
+
+    def rotate(self):
+        for i in range(self.keep, 0, -1):
+            older = self.path + "." + str(i)
+            if i == self.keep:
+                if os.path.exists(older):
+                    os.remove(older)
+            elif os.path.exists(older):
+                os.replace(older, self.path + "." + str(i + 1))
+        if self.keep > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+class PelletEstimator:
+    """Pellet consumption rates (kg/h, overall and per power level) and pellets left in the hopper,
+    updated in O(1) from the deltas of the pellet quantity used counter.
+
+    The counter has a 1 kg resolution: the rates are ratios of the kg used and the burning time accumulated
+    since the start (halved when the burning time gets over HORIZON, so that they follow the pellet quality).
+    """
+
+    HORIZON = 48 * 3600   # burning time (s) kept in the rates of each power level
+    MAX_GAP = 900         # longer intervals between two samples (disconnects) are not used for the rates
+    MAX_RATE = 5.0        # kg/h, a larger increase of the counter is a glitch (or a reset)
+
+    def __init__(self):
+        self.counter = None     # last value of the counter
+        self.lastSample = None  # time.monotonic() of the last sample, None after a restart
+        self.power = 0          # power level during the interval in progress
+        self.burning = False
+        self.kg = [0.0] * 6     # per power level (index 0: unknown level)
+        self.seconds = [0.0] * 6
+        self.remaining = None   # kg in the hopper, None until the first refill
+        self.changed = False    # state to be saved
+
+    def sample(self, now, counter, power, burning):
+        """Record a reading of the counter, with the current power level and burning state"""
+        if self.counter is None or counter < self.counter:
+            # first reading, or counter reset (new board, maintenance): start again from it
+            self.counter = counter
+        else:
+            delta = counter - self.counter
+            dt = now - self.lastSample if self.lastSample is not None else None
+            if dt is not None and delta > self.MAX_RATE * dt / 3600 + 1:
+                log.event("Pellet counter jump ignored: %s -> %s", self.counter, counter)
+            else:
+                if delta > 0 and self.remaining is not None:
+                    self.remaining = max(0.0, self.remaining - delta)
+                if dt is not None and dt <= self.MAX_GAP and self.burning:
+                    level = self.power if 0 < self.power <= 5 else 0
+                    self.kg[level] += delta
+                    self.seconds[level] += dt
+                    if self.seconds[level] > self.HORIZON:
+                        self.kg[level] /= 2
+                        self.seconds[level] /= 2
+            self.changed = self.changed or delta != 0
+            self.counter = counter
+        self.lastSample = now
+        self.power = power
+        self.burning = burning
+
+    def empty(self):
+        """The stove reported no pellets"""
+        if self.remaining != 0:
+            self.remaining = 0.0
+            self.changed = True
+
+    def refill(self, kg):
+        self.remaining = (self.remaining or 0.0) + kg
+        self.changed = True
+
+    def rate(self, level = None):
+        """kg/h at a power level (all levels if None), None if still unknown"""
+        if level is None:
+            kg, seconds = sum(self.kg), sum(self.seconds)
+        else:
+            kg, seconds = self.kg[level], self.seconds[level]
+        # less than an hour of burning is not meaningful with a 1 kg resolution
+        if seconds < 3600:
+            return None
+        return kg * 3600 / seconds
+
+    def burnRate(self):
+        """Current consumption in kg/h"""
+        if not self.burning:
+            return 0.0
+        rate = self.rate(self.power) if 0 < self.power <= 5 else None
+        return rate if rate is not None else self.rate()
+
+    def hoursLeft(self):
+        """Burning hours until the hopper is empty, at the current power level (average rate when not burning)"""
+        rate = self.burnRate() if self.burning else self.rate()
+        if self.remaining is None or not rate:
+            return None
+        return self.remaining / rate
+
+    def save(self):
+        self.changed = False
+        return { "counter": self.counter, "kg": list(self.kg), "seconds": list(self.seconds), "remaining": self.remaining }
+
+    def load(self, saved):
+        self.counter = saved["counter"]
+        self.remaining = saved["remaining"]
+        if len(saved["kg"]) == 6 and len(saved["seconds"]) == 6:
+            self.kg = [float(v) for v in saved["kg"]]
+            self.seconds = [float(v) for v in saved["seconds"]]
+
+class Histogram:
+    """Counts of values (in seconds) in fixed buckets: add() is O(log buckets) and allocates nothing"""
+
+    BOUNDS = tuple(0.00005 * 2 ** i for i in range(22))  # upper bounds of the buckets, 50 us to 105 s
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p, base = None):
+        """Upper bound of the bucket holding the p-th percentile, None without values.
+        base: counts of an earlier snapshot, to get the percentile of the values added since"""
+        counts = self.counts if base is None else [c - b for c, b in zip(self.counts, base)]
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = total * p / 100
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return "no values"
+        return (str(self.count)+" values, avg "+("%.2f" % (self.total / self.count * 1000))+" ms, p50 <= "+
+                ("%.2f" % (self.percentile(50) * 1000))+" ms, p95 <= "+("%.2f" % (self.percentile(95) * 1000))+
+                " ms, p99 <= "+("%.2f" % (self.percentile(99) * 1000))+" ms, max "+("%.2f" % (self.max * 1000))+" ms")
+
+class Metrics:
+    """Timing of the plugin callbacks. Only created when enabled: the callbacks are then replaced by timed wrappers,
+    so that nothing is measured (nor paid) otherwise."""
+
+    def __init__(self, period, now):
+        self.period = period
+        self.nextPublish = now + period
+        self.callbacks = {}           # callback name -> Histogram
+        self.all = Histogram()        # all the callbacks
+        self.base = list(self.all.counts)
+        self.boxBase = {}             # box index -> (RTT histogram counts, polls sent, polls OK) at the last publish
+
+    def wrap(self, name, callback):
+        histogram = self.callbacks.setdefault(name, Histogram())
+        total = self.all
+        perfCounter = time.perf_counter
+
+        def timed(*args):
+            start = perfCounter()
+            try:
+                return callback(*args)
+            finally:
+                elapsed = perfCounter() - start
+                histogram.add(elapsed)
+                total.add(elapsed)
+        return timed
+
+class LocalProxy:
+    """Local HTTP endpoint for the other consumers of the boxes (dashboards, scripts...), so that they do not poll them.
+
+    Requests (the box number prefix is optional, box 1 by default):
+      /<n>/state                          decoded state of the box, as JSON
+      /<n>/chrono                         cached chrono program of the box, edited with parameters (see Chrono.edited)
+      /<n>/cgi-bin/sendmsg.lua?cmd=...    the Connection Box API (sendmsg.php too): GET+ALLS is answered from the
+                                          last poll of the plugin when younger than ttl, other commands go through
+                                          the command queue of the plugin and the client waits for the reply.
+    """
+
+    TIMEOUT = 30  # seconds a client waits for a reply of the box
+
+    def __init__(self, conn, ttl):
+        self.conn = conn
+        self.ttl = ttl
+        self.waiters = {}  # (box index, command family) -> [(connection, deadline)]
+        self.requests = 0
+        self.cached = 0    # requests answered from the last poll
+
+    def parse(self, url, boxes):
+        """(box, path, command, parameters) of a request URL, box None if there is no such box"""
+        path, sep, query = url.partition("?")
+        parts = path.strip("/").split("/", 1)
+        index = 0
+        if parts[0].isdigit():
+            index = int(parts[0]) - 1
+            parts = parts[1:]
+        box = boxes[index] if 0 <= index < len(boxes) else None
+        parameters = {}
+        for item in query.split("&"):
+            name, sep, value = item.partition("=")
+            if name:
+                parameters[name] = unquote_plus(value).strip()
+        command = parameters.pop("cmd", None)
+        if command is not None:
+            command = command.upper().replace(" ", "+")
+        return box, "/".join(parts), command, parameters
+
+    def wait(self, box, command, connection, now):
+        self.waiters.setdefault((box.index, commandFamily(command)), []).append((connection, now + self.TIMEOUT))
+
+    def answer(self, box, command, body):
+        """Reply of the box to a command: answer the clients waiting for a command of its family"""
+        waiting = self.waiters.pop((box.index, commandFamily(command)), None)
+        if waiting is not None:
+            for connection, deadline in waiting:
+                self.send(connection, "200 OK", body)
+
+    def fail(self, box, command):
+        waiting = self.waiters.pop((box.index, commandFamily(command)), None)
+        if waiting is not None:
+            for connection, deadline in waiting:
+                self.send(connection, "502 Bad Gateway", b'{"error": "no reply from the Connection Box"}')
+
+    def expire(self, now):
+        for key in [key for key, waiting in self.waiters.items() if waiting[0][1] <= now]:
+            waiting = self.waiters.pop(key)
+            # in arrival order: the oldest ones first
+            while waiting and waiting[0][1] <= now:
+                self.send(waiting.pop(0)[0], "504 Gateway Timeout", b'{"error": "no reply from the Connection Box"}')
+            if waiting:
+                self.waiters[key] = waiting
+
+    def forget(self, connection):
+        """A client disconnected"""
+        for key in list(self.waiters):
+            waiting = [waiter for waiter in self.waiters[key] if waiter[0] is not connection]
+            if waiting:
+                self.waiters[key] = waiting
+            else:
+                del self.waiters[key]
+
+    def send(self, connection, status, body):
+        connection.Send({ "Status": status,
+                          "Headers": { "Content-Type": "application/json", "Connection": "keep-alive", "Cache-Control": "no-cache" },
+                          "Data": body })
+
+class ConnectionBox:
+    """State of one Palazzetti Connection Box: its connection, its stove status and its pending commands"""
+
+    def __init__(self, index, address, port):
+        self.index = index
+        self.address = address
+        self.port = port
+        self.unitBase = index * UNITS_PER_BOX
+        self.name = "cbox" if index == 0 else "cbox"+str(index + 1)
+
+        self.httpConn = None
+        self.link = None
+        self.headers = None
+        self.urlPrefix = None
+        self.scheduler = None
+        self.status = -1
+        self.onStatus = 0
+        self.commands = None
+        self.window = None
+        self.attempts = {}    # command -> number of attempts already failed
+        self.assembler = BodyAssembler()
+        self.malformed = 0
+        self.framingErrors = 0
+        self.decodeErrors = 0
+        self.history = None
+        self.historyRow = [NAN] * len(HISTORY_METRICS)
+        self.power = 0
+        self.pellets = PelletEstimator()
+        self.pelletsSavedAt = 0
+        self.lastPollSeq = 0
+        # fast path for the poll replies identical to the previous one
+        self.lastPollBody = None
+        self.lastPollTag = None
+        self.lastFingerprint = None
+        self.pollHits = 0
+        self.pollMisses = 0
+        self.lastSeen = None  # time.monotonic() of the last valid reply
+        self.pollsSent = 0
+        self.pollsOK = 0
+        self.reported = set()  # fields reported by the box since the start
+        self.stove = StoveState() # last decoded value of each field
+        self.written = {}      # field -> seq of the last command whose reply gave its value
+        self.alarm = None      # status code of the alarm in progress
+        self.optimistic = {}   # command family -> [local unit, last confirmed (nValue, sValue), command], shown before the reply
+        self.lastPollAt = None # time.monotonic() of the last poll reply (lastPollBody)
+        self.chrono = None       # cached weekly chrono program (Chrono)
+        self.chronoData = None   # (Programs, Days) of the last chrono reply, as received
+        self.chronoStale = True  # the cache has to be downloaded again
+        self.chronoTarget = None # program the box will have once the upload in progress is done
+        self.chronoPending = {}  # command family -> chrono command of the upload waiting for its reply
+        self.chronoEdit = None  # (changes, version) of a proxy edit waiting for the GET+CHRD that refreshes its base
+        self.lastPollData = None # payload of lastPollBody
+        self.exporter = None
+        self.exportAt = 0        # time.monotonic() of the next write of the export
+        self.api = "lua"         # API used for the requests: "lua" or "php"
+        self.probing = False     # the API is being detected: the first reply that does not match it switches to the other
+        self.mismatches = 0      # consecutive replies not matching the API
+        self.apiSince = 0        # seq of the first request sent with the API
+        self.firmware = None     # software version reported by the box
+        self.pollFields = None   # mapped fields of the GET+ALLS payload, None until known
+        self.snapshot = None     # last state snapshot written, without its time
+
+    def unit(self, localUnit):
+        return self.unitBase + localUnit
+
+    def prepareRequests(self, apiUri):
+        # built once: the same headers and URL prefix are used by every request
+        self.headers = { 'Content-Type': 'text/xml; charset=utf-8',
+                         'Connection': 'keep-alive',
+                         'Accept': 'Content-Type: text/html; charset=UTF-8',
+                         'Host': self.address+":"+self.port,
+                         'User-Agent':'Domoticz/1.0',
+                         'Content-Length' : "0" }
+        self.urlPrefix = apiUri+'?cmd='
+
+    def forgetPoll(self):
+        # the next poll reply is decoded in full, e.g. to undo the local update of a device after a command
+        self.lastPollBody = None
+        self.lastFingerprint = None
+
+    def deviceName(self, name):
+        # keep the historical names for the first box
+        if self.index == 0:
+            return name
+        return name+" #"+str(self.index + 1)
+
+    def __str__(self):
+        return self.address+":"+self.port
+
+def parseBoxAddresses(addresses, defaultPort):
+    """Parse the Address parameter: a comma (or semicolon) separated list of host[:port]"""
+    boxes = []
+    for item in addresses.replace(";", ",").split(","):
+        item = item.strip()
+        if item == "":
+            continue
+        host, sep, port = item.partition(":")
+        boxes.append(ConnectionBox(len(boxes), host.strip(), port.strip() if sep else defaultPort))
+    return boxes
+
+def formatNumber(value):
+    """sValue of a decimal field: 21 for 21.0, 20.5"""
+    return "%g" % value
+
+def formatHours(hours):
+    """sValue of the duration counters of the stove"""
+    return "%.1f" % hours
 
 class BasePlugin:
-    httpConn = None
-    nextConnect = 3
-    oustandingPings = 0
+    boxes = []
+    boxesByName = {}
     
     __UNIT_ONOFF = 1
     __UNIT_POWER = 2
@@ -50,73 +1232,100 @@ class BasePlugin:
     __UNIT_FAN_FAN1V = 12
     __UNIT_FAN_FAN1RPM = 13
     __UNIT_FAN_FAN2V = 14
+    __UNIT_ONTIME = 15
+    __UNIT_SERVICETIME = 16
+    __UNIT_LAST_ALARM = 17
+    __UNIT_ALARM = 24
+    __UNIT_PELLET_RATE = 20
+    __UNIT_PELLET_HOURS = 21
+    __UNIT_PELLET_LEFT = 22
+    __UNIT_PELLET_REFILL = 23
+    __UNIT_RTT = 40
+    __UNIT_POLL_SUCCESS = 41
+    __UNIT_RECONNECTS = 42
+    __UNIT_CALLBACK_P95 = 43 # first box only: the callbacks are shared by all the boxes
 
-    status = -1
-    onStatus = 0
-    
-    nextCommands = []
-    
-    __statusCodes = { "0": "OFF",
-                    "1": "OFF TIMER",
-                    "2": "TESTFIRE",
-                    "3": "HEATUP",
-                    "4": "FUELIGN",
-                    "5": "IGNTEST",
-                    "6": "BURNING",
-                    "9": "COOLFLUID",
-                    "10": "FIRESTOP",
-                    "11": "CLEANFIRE",
-                    "12": "COOL" }
-    
     # Custom translated Status codes               
     statusCodes = {}
 
-    alarmCodes = { "241": "CHIMNEY ALARM",
-                   "243": "GRATE ERROR",
-                   "244": "NTC2 ALARM",
-                   "245": "NTC3 ALARM",
-                   "247": "DOOR ALARM",
-                   "248": "PRESS ALARM",
-                   "249": "NTC1 ALARM",
-                   "250": "TC1 ALARM",
-                   "252": "GAS ALARM",
-                   "253": "NOPELLET ALARM" }
-    
-    # Choice of connection box API
-    # True stands for new API with LUA cgi script introduced mid-2018
-    # False stands for previous API using the Php frontend application
-    useNewLUA_API = True
-    __API_URI_PHP = "/sendmsg.php"
-    __API_URI_LUA = "/cgi-bin/sendmsg.lua"
-    API_URI = __API_URI_LUA
-
-    # JSON keys used in results
-    __JSON_KEYS = {
-            "php" : {
-                "INFO_KEY": "Info",
-                "ALL_DATA_KEY": "All Data",
-                "STATUS": "STATUS",
-                "POWER": "POWER",
-                "CHRSTATUS": "CHRSTATUS",
-                "SETP": "SETP",
-                "PELLET_QTUSED": "PELLET_QTUSED",
-                "TMP_ROOM": "TMP_ROOM_WATER",
-                "TMP_PELLET_BACKW": "TMP_PELLET_BACKW",
-                "TMP_EXHAUST": "TMP_EXHAUST",
-                "FAN_FAN2LEVEL": "FAN_FAN2LEVEL" },
-            "lua" : {
-                "INFO_KEY": "INFO",
-                "DATA_KEY": "DATA",
-                "STATUS": "STATUS",
-                "POWER": "PWR",
-                "CHRSTATUS": "CHRSTATUS",
-                "SETP": "SETP",
-                "PELLET_QTUSED": "PQT",
-                "TMP_ROOM": "T5",
-                "TMP_PELLET_BACKW": "T2",
-                "TMP_EXHAUST": "T3",
-                "FAN_FAN2LEVEL": "F2L" }
-        }
+    # Advanced options (in seconds), can be overridden with the Mode3 parameter
+    __defaultOptions = { "fastPoll": 4,       # poll interval after a command and during transitional states
+                         "normalPoll": 60,    # poll interval
+                         "idlePoll": 300,     # poll interval when the stove is OFF for a long time
+                         "fastWindow": 120,   # duration of fast polling after a command
+                         "idleDelay": 1800,   # duration of OFF status before polling slowly
+                         "debounce": 1,       # delay a user command is held, and minimum delay between two commands of the same family
+                         "maxInFlight": 2,    # maximum number of requests waiting for a reply, per box
+                         "requestTimeout": 10,# delay before a request without reply is considered lost
+                         "retries": 3,        # number of retries of a lost GET request
+                         "retryBackoff": 2,   # delay before the first retry, doubled at each retry
+                         "backoffMin": 5,     # delay before reconnecting after a failure, doubled at each failure
+                         "backoffMax": 300,   # maximum delay before reconnecting
+                         "idleTimeout": 120,  # idle time before closing the connection while the stove is OFF
+                         "connectLead": 4,    # connect this delay before a scheduled poll
+                         "history": True,     # record the telemetry history in the plugin folder
+                         "historyDays": 7,    # days of minute-level history (hourly: 90 days, daily: 3 years)
+                         "refillKg": 15,      # kg of pellets added to the hopper at each refill
+                         "metrics": False,    # time the callbacks and the requests, with devices showing a summary
+                         "metricsPeriod": 300,# period of the summary
+                         "trace": 100,        # number of recent events logged after an error
+                         "proxyPort": 0,      # port of the local proxy for the other consumers of the boxes, 0: none
+                         "proxyTtl": 5,       # age of the last poll under which the proxy does not poll again
+                         "workerQueue": 256,  # maximum number of jobs waiting for the background worker
+                         "export": "",        # export of the raw poll payloads: "influx" (line protocol), "csv", "": none
+                         "exportFlush": 60,   # interval between two writes of the export
+                         "exportMaxBytes": 10000000, # size of an export file before it is rotated
+                         "exportKeep": 5,     # number of rotated export files kept
+                         "snapshotPeriod": 60 } # interval between two saves of the state snapshot (also saved at stop)
+    options = {}
+
+    alarmCodes = ALARM_CODES
+
+    # Choice of connection box API: "lua" for the new API with LUA cgi script introduced mid-2018,
+    # "php" for the previous API using the Php frontend application, "auto" to detect it (cached in api-N.json)
+    apiMode = "auto"
+
+    # Devices of a box, created when the box reports their field for the first time (and missing in Domoticz).
+    # unit, field, formatter, handler, device name, Domoticz.Device arguments
+    # The fields are decoded into typed values with palazzetti.FIELDS, STATUS first as the other handlers use it.
+    # handler: None to update the device with the sValue given by the formatter, a method name called with the value,
+    # or "" for a device updated elsewhere.
+    # types / subtypes reference: https://github.com/domoticz/domoticz/blob/master/hardware/hardwaretypes.h
+    # Image index for switches: Fireplace: 10, Fan: 7, Heating: 15
+    __DEVICES = (
+        (__UNIT_STATUS, "STATUS", None, "onStatusDecoded", "Status code", { "TypeName": "Text", "Used": 0 }),
+        (__UNIT_ONOFF, "STATUS", None, "onOnOffDecoded", "On-Off", { "TypeName": "Switch", "Image": 10, "Used": 1 }),
+        (__UNIT_STATUSLABEL, "STATUS", None, "onStatusLabelDecoded", "Status", { "TypeName": "Text", "Used": 1 }),
+        (__UNIT_LAST_ALARM, "STATUS", None, "onLastAlarmDecoded", "Last Alarm", { "TypeName": "Text", "Used": 1 }),
+        (__UNIT_ALARM, "STATUS", None, "onAlarmDecoded", "Alarm", { "Type": 243, "Subtype": 22, "Used": 1 }),
+        (__UNIT_POWER, "POWER", None, "onPowerLevelDecoded", "Power Level", { "TypeName": "Selector Switch", "Image": 10, "Used": 1,
+            "Options": { "LevelActions": "|||||", "LevelNames": "Off|1|2|3|4|5", "LevelOffHidden": "true", "SelectorStyle": "1" } }),
+        (__UNIT_FAN2LEVEL, "FAN_FAN2LEVEL", None, "onFanLevelDecoded", "Fan Speed", { "TypeName": "Selector Switch", "Image": 7, "Used": 1,
+            "Options": { "LevelActions": "|||||||", "LevelNames": "Off|1|2|3|4|5|Auto|Hi", "LevelOffHidden": "false", "SelectorStyle": "1" } }),
+        (__UNIT_SETP, "SETP", formatNumber, None, "Setpoint", { "Type": 242, "Subtype": 1, "Image": 15, "Used": 1 }),
+        (__UNIT_TMP_ROOM, "TMP_ROOM", formatNumber, None, "Room Temperature", { "TypeName": "Temperature", "Used": 1 }),
+        (__UNIT_PELLET_QTUSED, "PELLET_QTUSED", str, None, "Pellets Qty Used", { "Type": 113, "Subtype": 0, "Switchtype": 3, "Used": 1 }),
+        (__UNIT_PELLET_RATE, "PELLET_QTUSED", None, "onPelletCounterDecoded", "Pellets Burn Rate", { "Type": 243, "Subtype": 31, "Options": { "Custom": "1;kg/h" }, "Used": 1 }),
+        (__UNIT_PELLET_HOURS, "PELLET_QTUSED", None, "", "Pellets Hours Left", { "Type": 243, "Subtype": 31, "Options": { "Custom": "1;h" }, "Used": 1 }),
+        (__UNIT_PELLET_LEFT, "PELLET_QTUSED", None, "", "Pellets Left", { "Type": 243, "Subtype": 31, "Options": { "Custom": "1;kg" }, "Used": 1 }),
+        (__UNIT_PELLET_REFILL, "PELLET_QTUSED", None, "", "Pellets Refilled", { "TypeName": "Switch", "Switchtype": 9, "Image": 10, "Used": 1 }),
+        (__UNIT_TIMER_ONOFF, "CHRSTATUS", None, "onChronoStatusDecoded", "Timer", { "TypeName": "Switch", "Image": 1, "Used": 1 }),
+        (__UNIT_TMP_PELLET_BACKW, "TMP_PELLET_BACKW", formatNumber, None, "Pellet Backwall Temperature", { "TypeName": "Temperature", "Used": 0 }),
+        (__UNIT_TMP_EXHAUST, "TMP_EXHAUST", formatNumber, None, "Exhaust Temperature", { "TypeName": "Temperature", "Used": 0 }),
+        (__UNIT_FAN_FAN1V, "FAN_FAN1V", formatNumber, None, "Exhaust Fan Voltage", { "Type": 243, "Subtype": 31, "Options": { "Custom": "1;V" }, "Used": 0 }),
+        (__UNIT_FAN_FAN1RPM, "FAN_FAN1RPM", str, None, "FAN_FAN1RPM", { "Type": 243, "Subtype": 7, "Used": 0 }),
+        (__UNIT_FAN_FAN2V, "FAN_FAN2V", formatNumber, None, "Room Fan Voltage", { "Type": 243, "Subtype": 31, "Options": { "Custom": "1;V" }, "Used": 0 }),
+        (__UNIT_ONTIME, "ONTIME", formatHours, None, "On Time", { "Type": 243, "Subtype": 31, "Options": { "Custom": "1;h" }, "Used": 0 }),
+        (__UNIT_SERVICETIME, "SERVICETIME", formatHours, None, "Service Time", { "Type": 243, "Subtype": 31, "Options": { "Custom": "1;h" }, "Used": 0 }) )
+
+    decoders = {}
+    targets = {}
+    deviceSpecs = {}
+    proxy = None
+    devices = None
+    snapshotAt = 0
+    metrics = None
+    debug = False
 
     def __init__(self):
         return
@@ -124,229 +1333,901 @@ class BasePlugin:
     def onStart(self):
     
         # duplicate status codes
-        self.statusCodes = self.__statusCodes.copy()
+        self.statusCodes = STATUS_CODES.copy()
     
         # Domoticz.Debug("onStart called")
         if Parameters["Mode6"] == "Debug":
             Domoticz.Debugging(1)
+            self.debug = True
+        log.debugging = self.debug
+
+        # advanced options
+        self.options = self.__defaultOptions.copy()
+        self.updateOptions(Parameters["Mode3"])
+        log.resize(int(self.options["trace"]))
+        worker.start(max(1, int(self.options["workerQueue"])))
+
+        if Parameters["Mode5"].strip() != "":
+            self.updateCustomStatusCodes(Parameters["Mode5"])
             
-        # Use new cbox LUA API instead of PHP ?
-        if Parameters["Mode4"] == "False":
-            self.useNewLUA_API = False
+        # Connection Box API: "True" (the former default) for the LUA API, "False" for the PHP one, else detected
+        self.apiMode = { "True": "lua", "False": "php" }.get(Parameters["Mode4"], "auto")
+        log.debug("Connection Box API: %s", self.apiMode)
+
+        # field -> ((unit, handler, formatter), ...): a field can update several devices
+        self.targets = {}
+        for unit, field, formatter, handler, name, arguments in self.__DEVICES:
+            if handler != "":
+                self.targets[field] = self.targets.get(field, ()) + ((unit, getattr(self, handler) if handler else None, formatter),)
+        # response decoding tables of the APIs, for the fields of the devices: each box uses the one of its API
+        fields = [(field, converter) for field, converter in FIELDS if field in self.targets]
+        self.decoders = { api: ResponseDecoder(api, fields) for api in API_URIS }
+        # field -> devices to create when the field is reported
+        self.deviceSpecs = {}
+        for unit, field, formatter, handler, name, arguments in self.__DEVICES:
+            self.deviceSpecs.setdefault(field, []).append((unit, name, arguments))
+
+        self.boxes = parseBoxAddresses(Parameters["Address"], Parameters["Port"])
+        if len(self.boxes) > MAX_BOXES:
+            log.error("Too many Connection Boxes, only the first %d will be used", MAX_BOXES)
+            self.boxes = self.boxes[:MAX_BOXES]
+        self.boxesByName = {}
+        self.devices = DeviceCache()
+
+        now = time.monotonic()
+        for box in self.boxes:
+            self.boxesByName[box.name] = box
+            if self.options["metrics"]:
+                self.createMetricsDevices(box)
+            self.loadPellets(box)
+            self.loadChrono(box)
+            self.loadApi(box)
+
+            # spread the polls of the boxes over one poll cycle
+            box.scheduler = PollScheduler(self.options["fastPoll"], self.options["normalPoll"], self.options["idlePoll"],
+                                          self.options["fastWindow"], self.options["idleDelay"])
+            box.scheduler.start(now, 30 + (box.index * self.options["normalPoll"]) / len(self.boxes))
+
+            # prepare first commande before connecting
+            # a command not sent during the fast polling that follows it is not worth sending any more
+            box.commands = CommandQueue(self.options["debounce"], self.options["fastWindow"])
+            box.window = InFlightWindow(max(1, int(self.options["maxInFlight"])), self.options["requestTimeout"])
+            box.commands.push("GET+ALLS", False, now)
+            self.loadSnapshot(box, now)
+
+            # no need for CHRD when the Chrono status info is returned part of the GET+ALLS cmd,
+            # unless the chrono program is not cached yet
+            if self.needsChronoPoll(box):
+                box.commands.push("GET+CHRD", False, now)
+
+            box.prepareRequests(API_URIS[box.api])
+            box.httpConn = Domoticz.Connection(Name=box.name, Transport="TCP/IP", Protocol="HTTP", Address=box.address, Port=box.port)
+            box.link = BoxLink(box.httpConn, self.options["backoffMin"], self.options["backoffMax"])
+            box.link.connect(now)
+
+            if self.options["history"]:
+                self.openHistory(box)
+            if self.options["export"]:
+                self.openExport(box, now)
+
+        self.devices.load()
+        self.snapshotAt = now + self.options["snapshotPeriod"]
+
+        self.proxy = None
+        if self.options["proxyPort"] > 0:
+            listener = Domoticz.Connection(Name="proxy", Transport="TCP/IP", Protocol="HTTP", Port=str(self.options["proxyPort"]))
+            listener.Listen()
+            self.proxy = LocalProxy(listener, self.options["proxyTtl"])
+            Domoticz.Log("Local proxy listening on port "+str(self.options["proxyPort"]))
+
+        # timing of the callbacks, also available in Debug mode (Debug log only)
+        self.metrics = None
+        if self.options["metrics"] or self.debug:
+            self.startMetrics(now)
+
+        Domoticz.Heartbeat(HEARTBEAT)
+
+
+    def createReportedDevices(self, box, state):
+        # devices of the fields reported for the first time since the start, if missing (e.g. new in this version)
+        for field in state:
+            if field in box.reported:
+                continue
+            box.reported.add(field)
+            for unit, name, arguments in self.deviceSpecs.get(field, ()):
+                if box.unit(unit) not in Devices:
+                    log.event("Creating device %s of %s", name, box)
+                    Domoticz.Device(Name=box.deviceName(name), Unit=box.unit(unit), **arguments).Create()
+
+    def createMetricsDevices(self, box):
+        if box.unit(self.__UNIT_RTT) not in Devices:
+            Domoticz.Device(Name=box.deviceName("Box Round-Trip Time"), Unit=box.unit(self.__UNIT_RTT), Type=243, Subtype=31, Options={"Custom": "1;ms"}, Used=0).Create()
+        if box.unit(self.__UNIT_POLL_SUCCESS) not in Devices:
+            Domoticz.Device(Name=box.deviceName("Poll Success"), Unit=box.unit(self.__UNIT_POLL_SUCCESS), Type=243, Subtype=6, Used=0).Create()
+        if box.unit(self.__UNIT_RECONNECTS) not in Devices:
+            Domoticz.Device(Name=box.deviceName("Reconnects"), Unit=box.unit(self.__UNIT_RECONNECTS), Type=243, Subtype=31, Options={"Custom": "1;"}, Used=0).Create()
+        if box.index == 0 and box.unit(self.__UNIT_CALLBACK_P95) not in Devices:
+            Domoticz.Device(Name="Plugin Callback p95", Unit=box.unit(self.__UNIT_CALLBACK_P95), Type=243, Subtype=31, Options={"Custom": "1;ms"}, Used=0).Create()
+
+    def startMetrics(self, now):
+        self.metrics = Metrics(self.options["metricsPeriod"], now)
+        # instance attributes take precedence over the methods called by the module level callbacks
+        for name in ("onConnect", "onMessage", "onCommand", "onDisconnect", "onHeartbeat"):
+            self.__dict__.pop(name, None)  # wrapped by a previous onStart
+            setattr(self, name, self.metrics.wrap(name, getattr(self, name)))
+        for box in self.boxes:
+            box.window.rttHistogram = Histogram()
+            self.metrics.boxBase[box.index] = (list(box.window.rttHistogram.counts), 0, 0)
+
+    def publishMetrics(self, now):
+        metrics = self.metrics
+        metrics.nextPublish = now + metrics.period
+        if self.options["metrics"]:
+            p95 = metrics.all.percentile(95, metrics.base)
+            if p95 is not None:
+                self.devices.stage(self.boxes[0].unit(self.__UNIT_CALLBACK_P95), 0, "%.2f" % (p95 * 1000))
+        metrics.base = list(metrics.all.counts)
+
+        for box in self.boxes:
+            rttBase, sentBase, okBase = metrics.boxBase[box.index]
+            histogram = box.window.rttHistogram
+            if self.options["metrics"]:
+                rtt = histogram.percentile(50, rttBase)
+                if rtt is not None:
+                    self.devices.stage(box.unit(self.__UNIT_RTT), 0, "%.0f" % (rtt * 1000))
+                if box.pollsSent > sentBase:
+                    ratio = min(100.0, 100.0 * (box.pollsOK - okBase) / (box.pollsSent - sentBase))
+                    self.devices.stage(box.unit(self.__UNIT_POLL_SUCCESS), 0, "%.1f" % ratio)
+                self.devices.stage(box.unit(self.__UNIT_RECONNECTS), 0, str(box.link.reconnects))
+            metrics.boxBase[box.index] = (list(histogram.counts), box.pollsSent, box.pollsOK)
+        self.devices.flush(self.debug)
+
+        if self.debug:
+            self.dumpMetrics()
+
+    def dumpMetrics(self):
+        for name, histogram in self.metrics.callbacks.items():
+            Domoticz.Debug("Metrics "+name+": "+histogram.summary())
+        for box in self.boxes:
+            Domoticz.Debug("Metrics "+str(box)+" round-trip time: "+box.window.rttHistogram.summary()+", "+
+                           str(box.pollsOK)+"/"+str(box.pollsSent)+" polls answered, "+str(box.link.reconnects)+" reconnects")
+
+    def pelletsPath(self, box):
+        return os.path.join(Parameters["HomeFolder"], "pellets-"+str(box.index + 1)+".json")
+
+    def loadPellets(self, box):
+        try:
+            with open(self.pelletsPath(box)) as f:
+                box.pellets.load(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.error("Pellet consumption state of %s ignored: %s", box, e)
+
+    def savePellets(self, box, now):
+        box.pelletsSavedAt = now
+        worker.submit(("pellets", box.index), self.writeJSON, self.pelletsPath(box), box.pellets.save(),
+                      "the pellet consumption state of "+str(box))
+
+    def writeJSON(self, path, value, description):
+        # in the worker thread
+        try:
+            with open(path, "w") as f:
+                json.dump(value, f)
+        except OSError as e:
+            Domoticz.Error("Cannot save "+description+": "+str(e))
+
+    def updatePellets(self, box, now):
+        pellets = box.pellets
+        rate = pellets.burnRate()
+        if rate is not None:
+            self.devices.stage(box.unit(self.__UNIT_PELLET_RATE), 0, "%.2f" % rate)
+        hours = pellets.hoursLeft()
+        if hours is not None:
+            self.devices.stage(box.unit(self.__UNIT_PELLET_HOURS), 0, "%.1f" % hours)
+        if pellets.remaining is not None:
+            self.devices.stage(box.unit(self.__UNIT_PELLET_LEFT), 0, "%.1f" % pellets.remaining)
+        # the counter moves by 1 kg steps: saving every 10 minutes at most is enough
+        if pellets.changed and now - box.pelletsSavedAt >= 600:
+            self.savePellets(box, now)
+
+    def apiPath(self, box):
+        return os.path.join(Parameters["HomeFolder"], "api-"+str(box.index + 1)+".json")
+
+    def loadApi(self, box):
+        """API of the box: forced by the Mode4 parameter, cached by a previous detection, or to detect"""
+        cached = None
+        try:
+            with open(self.apiPath(box)) as f:
+                cached = json.load(f)
+            if cached["api"] not in API_URIS or not isinstance(cached["fields"], list):
+                raise ValueError("unknown API")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.error("Cached API of %s ignored: %s", box, e)
+            cached = None
+        # the cache is for this box only: a new address is probed again
+        if cached is not None and cached.get("address") != str(box):
+            cached = None
+
+        if self.apiMode != "auto":
+            box.api = self.apiMode
+        elif cached is not None:
+            box.api = cached["api"]
+        else:
+            box.api = "lua"
+            box.probing = True
+        if cached is not None and cached["api"] == box.api:
+            box.firmware = cached.get("firmware")
+            box.pollFields = cached["fields"]
+        log.debug("%s: %s API%s", box, box.api, " (probing)" if box.probing else "")
+
+    def saveApi(self, box):
+        worker.submit(("api", box.index), self.writeJSON, self.apiPath(box),
+                      { "address": str(box), "api": box.api, "firmware": box.firmware, "fields": box.pollFields },
+                      "the API of "+str(box))
+
+    def needsChronoPoll(self, box):
+        # GET+CHRD downloads the chrono program, and the chrono status when GET+ALLS does not report it
+        if box.chronoStale:
+            return True
+        if box.pollFields is None:
+            return box.api == "php"
+        return "CHRSTATUS" not in box.pollFields
+
+    def onApiMismatch(self, box, request):
+        """A reply to request was not a reply of the API of the box (HTTP error, other format)"""
+        if request.seq < box.apiSince:
+            # sent before the last API switch
+            return
+        box.mismatches += 1
+        if self.apiMode != "auto":
+            if box.mismatches == API_MISMATCHES:
+                log.error("Replies of %s do not match the %s API: check the Connection Box API parameter", box, box.api)
+        elif box.probing or box.mismatches >= API_MISMATCHES:
+            # e.g. a firmware update of the box: probe the other API
+            self.switchApi(box, "php" if box.api == "lua" else "lua")
+
+    def switchApi(self, box, api):
+        Domoticz.Log("Trying the "+api.upper()+" API of "+str(box))
+        box.api = api
+        box.probing = True
+        box.mismatches = 0
+        box.apiSince = box.window.seq + 1
+        box.pollFields = None
+        box.prepareRequests(API_URIS[api])
+        box.forgetPoll()
+
+    def onApiConfirmed(self, box, decoder, data):
+        """First poll payload with the API being probed, or with another firmware version: cache the capabilities"""
+        firmware = decoder.firmware(data)
+        if box.probing or box.firmware is None:
+            Domoticz.Log("Connection Box "+str(box)+" uses the "+box.api.upper()+" API, firmware "+str(firmware))
         else:
-            self.useNewLUA_API = True
+            Domoticz.Log("Connection Box "+str(box)+" firmware changed from "+str(box.firmware)+" to "+str(firmware))
+        box.probing = False
+        box.firmware = firmware
+        box.pollFields = decoder.supported(data)
+        self.saveApi(box)
+
+    def snapshotPath(self, box):
+        return os.path.join(Parameters["HomeFolder"], "state-"+str(box.index + 1)+".json")
+
+    def saveSnapshot(self, box, now, force = False):
+        """Save what a restart would lose: the decoded state, the pending commands and the poll schedule"""
+        wall = time.time()
+        # commands sent and not answered yet may have been applied: they are never sent again, only rolled back
+        inFlight = [request.command for request in box.window.requests if not request.command.startswith("GET+")]
+        # queued commands, with their deadline in wall clock time
+        commands = [[command, round(deadline - now + wall)] for command, deadline in box.commands.userCommands()]
+        snapshot = { "address": str(box), "api": box.api, "state": box.stove.fields(),
+                     "status": box.status, "power": box.power, "alarm": box.alarm,
+                     "fingerprint": None if box.lastFingerprint is None else list(box.lastFingerprint),
+                     "commands": commands, "inFlight": inFlight,
+                     "optimistic": dict((family, list(entry)) for family, entry in box.optimistic.items()) }
+        # the schedule moves at each poll: not worth a write on its own
+        if snapshot == box.snapshot and not force:
+            return
+        box.snapshot = snapshot
+        saved = dict(snapshot, savedAt=wall, scheduler=box.scheduler.save(now, wall))
+        worker.submit(("snapshot", box.index), self.writeJSON, self.snapshotPath(box), saved, "the state of "+str(box))
+
+    def loadSnapshot(self, box, now):
+        """Resume from the snapshot of the previous run: the first poll only has to confirm the state"""
+        try:
+            with open(self.snapshotPath(box)) as f:
+                saved = json.load(f)
+            if saved["address"] != str(box):
+                return
+            wall = time.time()
+            age = wall - saved["savedAt"]
+            # same converters as the decoding, a corrupt value is not sent to the devices
+            converters = dict(FIELDS)
+            state = dict((field, converters[field](value)) for field, value in saved["state"].items()
+                         if field in self.targets and field in converters)
+            status, power, alarm = int(saved["status"]), int(saved["power"]), saved["alarm"]
+            fingerprint = saved["fingerprint"]
+            commands = [(str(command), float(deadline)) for command, deadline in saved["commands"]]
+            inFlight = [str(command) for command in saved["inFlight"]]
+            optimistic = saved["optimistic"]
+            box.scheduler.load(saved["scheduler"], now, wall)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            log.error("State snapshot of %s ignored: %s", box, e)
+            return
+
+        box.stove = StoveState(state)
+        box.status = status
+        box.onStatus = 1 if isRunning(status) else 0
+        box.power = power
+        box.alarm = alarm
+        # the fingerprint of the same API and decoding table: an unchanged first poll is not decoded again
+        if fingerprint is not None and saved["api"] == box.api:
+            box.lastFingerprint = tuple(fingerprint)
+        self.updateHistoryRow(box, state)
+        self.createReportedDevices(box, state)
+
+        pending = inFlight + [command for command, deadline in commands]
+        for family, (unit, confirmed, command) in optimistic.items():
+            if command in pending:
+                box.optimistic[family] = [unit, None if confirmed is None else tuple(confirmed), command]
+        # a command older than the queue timeout is dropped, as it would have been without the restart
+        resumed = [(command, deadline) for command, deadline in commands if deadline > wall]
+        for command in inFlight + [command for command, deadline in commands if deadline <= wall]:
+            if commandName(command) in INDEXED_COMMANDS:
+                self.onChronoCommandLost(box, command)
+            reason = "may not have been applied before the restart" if command in inFlight else "was not sent before the restart"
+            if not self.rollbackOptimistic(box, command, reason):
+                log.error("Command %s to %s %s", command, box, reason)
+        if resumed:
+            log.event("Resuming %d pending command(s) of %s", len(resumed), box)
+            for command, deadline in resumed:
+                box.commands.push(command, True, now, timeout = deadline - wall)
+            self.commandFromUser(box)
+        log.debug("%s resumed from a %d s old snapshot: status %s", box, age, status)
+
+    def chronoPath(self, box):
+        return os.path.join(Parameters["HomeFolder"], "chrono-"+str(box.index + 1)+".json")
 
-        # Set some variables according to API choice
-        if self.useNewLUA_API:
-            # we set variables so that they are up-to-date
-            Domoticz.Debug("Will use the new LUA API backend")
-            self.API_URI = self.__API_URI_LUA
+    def loadChrono(self, box):
+        try:
+            with open(self.chronoPath(box)) as f:
+                cached = json.load(f)
+            chrono = Chrono.fromDict(cached["chrono"])
+            if chrono.version != cached["version"]:
+                raise ValueError("version mismatch")
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.error("Cached chrono program of %s ignored: %s", box, e)
+            return
+        box.chrono = chrono
+        box.chronoStale = False
+
+    def saveChrono(self, box):
+        worker.submit(("chrono", box.index), self.writeJSON, self.chronoPath(box),
+                      { "version": box.chrono.version, "chrono": box.chrono.asDict() }, "the chrono program of "+str(box))
+
+    def onChronoReply(self, box, command, data):
+        """Reply of the box to GET+CHRD or to a chrono command (ours or of a proxy client): update the cache"""
+        family = commandFamily(command)
+        if box.chronoPending.get(family) == command:
+            del box.chronoPending[family]
+            if not box.chronoPending:
+                box.chronoTarget = None
+
+        chrono = None
+        if data is not None and "Programs" in data:
+            raw = (data.get("Programs"), data.get("Days"))
+            if raw == box.chronoData and box.chrono is not None:
+                # the PHP API downloads it at each poll: most of the time it did not change
+                box.chronoStale = False
+                return
+            chrono = Chrono.fromData(data)
+            if chrono is not None:
+                box.chronoData = raw
+                box.chronoStale = False
+        elif command != "GET+CHRD" and box.chrono is not None:
+            # the reply does not hold the program: the command was applied
+            chrono = box.chrono.applied(command)
+
+        if chrono is not None and chrono != box.chrono:
+            log.event("%s: chrono program %s -> %s", box, box.chrono.version if box.chrono else None, chrono.version)
+            box.chrono = chrono
+            self.saveChrono(box)
+
+    def onChronoCommandLost(self, box, command):
+        # the program of the box is unknown now: download it again
+        family = commandFamily(command)
+        if box.chronoPending.get(family) == command:
+            del box.chronoPending[family]
+        box.chronoTarget = None
+        box.chronoStale = True
+        box.chronoData = None
+        if not box.window.has("GET+CHRD"):
+            box.commands.push("GET+CHRD", False, time.monotonic())
+
+    def onChronoRequest(self, box, parameters):
+        """(HTTP status, reply) of a proxy request on the chrono program: read it, edit it (upload of the changes
+        only), or download it again (refresh)"""
+        if "refresh" in parameters:
+            box.chronoStale = True
+            box.chronoData = None
+            if not box.window.has("GET+CHRD"):
+                box.commands.push("GET+CHRD", False, time.monotonic())
+            self.sendPendingCommands(box)
+            return "202 Accepted", { "commands": ["GET+CHRD"] }
+
+        base = box.chronoTarget or box.chrono
+        changes = dict((name, value) for name, value in parameters.items() if name != "version")
+        if not changes:
+            return "200 OK", { "version": base.version if base else None, "chrono": base.asDict() if base else None,
+                               "stale": box.chronoStale, "pending": sorted(box.chronoPending.values()) }
+        if base is None:
+            return "503 Service Unavailable", { "error": "chrono program not downloaded yet" }
+        if parameters.get("version", base.version) != base.version:
+            return "409 Conflict", { "error": "chrono program changed", "version": base.version }
+        try:
+            base.edited(changes)
+        except ValueError as e:
+            return "400 Bad Request", { "error": str(e) }
+
+        if box.chronoTarget is not None:
+            # an upload of ours is in progress: its target is what the box is being set to
+            return "202 Accepted", self.uploadChrono(box, box.chronoTarget, changes)
+        # the program may have been changed from the app since it was cached (never checked again on LUA):
+        # download it first, the diff is computed on the reply
+        box.chronoStale = True
+        if box.chronoEdit is None:
+            box.chronoEdit = ({}, parameters.get("version"))
+        box.chronoEdit[0].update(changes)
+        if not box.window.has("GET+CHRD"):
+            box.commands.push("GET+CHRD", False, time.monotonic())
+        self.sendPendingCommands(box)
+        return "202 Accepted", { "commands": ["GET+CHRD"], "changes": dict(box.chronoEdit[0]) }
+
+    def onChronoRefreshed(self, box):
+        """Reply to the GET+CHRD sent before an edit: upload the edit diffed against the program of the box"""
+        changes, version = box.chronoEdit
+        box.chronoEdit = None
+        if box.chrono is None or box.chronoStale:
+            log.error("Chrono edit of %s dropped: program not downloaded", box)
+        elif version is not None and version != box.chrono.version:
+            log.error("Chrono edit of %s dropped: program changed on the box (version %s)", box, box.chrono.version)
         else:
-            Domoticz.Debug("Will use the old PHP API backend")
-            self.API_URI = self.__API_URI_PHP
+            try:
+                self.uploadChrono(box, box.chrono, changes)
+            except ValueError as e:
+                log.error("Chrono edit of %s dropped: %s", box, e)
 
-        if (len(Devices) == 0):
-            # types / subtypes reference: https://github.com/domoticz/domoticz/blob/master/hardware/hardwaretypes.h
-            # Image index for switches: Fireplace: 10, Fan: 7, Heating: 15, Generic: 
-            
-            # On/Off switch
-            Domoticz.Device(Name="On-Off", Unit=self.__UNIT_ONOFF, TypeName="Switch", Image=10, Used=1).Create()
-            
-            # Power selector switch
-            PowerSelectorOptions = {"LevelActions": "|||||",
-                                    "LevelNames": "Off|1|2|3|4|5",
-                                    "LevelOffHidden": "true",
-                                    "SelectorStyle": "1"}
-            Domoticz.Device(Name="Power Level", Unit=self.__UNIT_POWER, TypeName="Selector Switch", Image=10, Options=PowerSelectorOptions, Used=1).Create()
-            
-            # Fan speed selector switch
-            FanSpeedSelectorOptions = {"LevelActions": "|||||||",
-                                       "LevelNames": "Off|1|2|3|4|5|Auto|Hi",
-                                       "LevelOffHidden": "false",
-                                       "SelectorStyle": "1"}
-            Domoticz.Device(Name="Fan Speed", Unit=self.__UNIT_FAN2LEVEL, TypeName="Selector Switch", Image=7, Options=FanSpeedSelectorOptions, Used=1).Create()
-            
-            # Setpoint
-            Domoticz.Device(Name="Setpoint", Unit=self.__UNIT_SETP, Type=242, Subtype=1, Image=15, Used=1).Create()
-            
-            # Room Temperature
-            Domoticz.Device(Name="Room Temperature", Unit=self.__UNIT_TMP_ROOM, TypeName="Temperature", Used=1).Create()
-            
-            #  pellet counter
-            Domoticz.Device(Name="Pellets Qty Used", Unit=self.__UNIT_PELLET_QTUSED, Type=113, Subtype=0, Switchtype=3, Used=1).Create()
-      
-            # Status code
-            Domoticz.Device(Name="Status code", Unit=self.__UNIT_STATUS, TypeName="Text", Used=0).Create()
-            
-            # Status Label
-            Domoticz.Device(Name="Status", Unit=self.__UNIT_STATUSLABEL, TypeName="Text", Used=1).Create()
-            
-            # Timer On/Off switch
-            Domoticz.Device(Name="Timer", Unit=self.__UNIT_TIMER_ONOFF, TypeName="Switch",Image=1,  Used=1).Create()
-            
-            # TMP_PELLET_BACKW
-            Domoticz.Device(Name="Pellet Backwall Temperature", Unit=self.__UNIT_TMP_PELLET_BACKW, TypeName="Temperature", Used=0).Create()
-            
-            # TMP_EXHAUST
-            Domoticz.Device(Name="Exhaust Temperature", Unit=self.__UNIT_TMP_EXHAUST, TypeName="Temperature", Used=0).Create()
-            
-            # __UNIT_FAN_FAN1V
-            
-            # __UNIT_FAN_FAN1RPM
-            Domoticz.Device(Name="FAN_FAN1RPM", Unit=self.__UNIT_FAN_FAN1RPM, Type=243, Subtype=7 , Used=0).Create()
+    def uploadChrono(self, box, base, changes):
+        """Queue the chrono commands that edit base with changes, and return the proxy reply"""
+        target = base.edited(changes)
+        commands = base.diff(target)
+        log.event("Chrono upload to %s: %s", box, commands)
+        if commands:
+            box.chronoTarget = target
+            for command in commands:
+                box.chronoPending[commandFamily(command)] = command
+            self.commandFromUser(box)
+            for command in commands:
+                self.queueCommand(box, command)
+        return { "version": target.version, "commands": commands }
 
-        # prepare first commande before connecting
-        self.nextCommands.append("GET+ALLS")
+    def onHistoryRequest(self, box, parameters):
+        """(HTTP status, reply) of a proxy request on the telemetry history of a metric"""
+        if box.history is None:
+            return "404 Not Found", { "error": "no telemetry history" }
+        metric = parameters.get("metric", "").upper()
+        resolution = parameters.get("resolution", "hour")
+        if metric not in HISTORY_INDEX or resolution not in ("minute", "hour", "day"):
+            return "400 Bad Request", { "error": "metric: one of "+", ".join(HISTORY_METRICS)+", resolution: minute, hour or day" }
+        try:
+            start, end = int(parameters.get("start", 0)), int(parameters.get("end", 2 ** 32))
+        except ValueError:
+            return "400 Bad Request", { "error": "start and end are Unix timestamps" }
+        # NaN (no value) is not valid JSON
+        rows = [[None if value != value else value for value in row] for row in box.history.query(metric, start, end, resolution)]
+        columns = ["time", "value"] if resolution == "minute" else ["time", "min", "max", "avg"]
+        return "200 OK", { "metric": metric, "resolution": resolution, "columns": columns, "rows": rows }
 
-        # no need for CHRD with new API because Chrono status info is returned part of the GET+ALLS cmd
-        if not self.useNewLUA_API:
-            self.nextCommands.append("GET+CHRD")
+    def openHistory(self, box):
+        path = os.path.join(Parameters["HomeFolder"], "history-"+str(box.index + 1)+".bin")
+        try:
+            box.history = TelemetryHistory(path, HISTORY_METRICS, int(self.options["historyDays"] * 1440), 90 * 24, 3 * 366)
+        except (OSError, ValueError) as e:
+            log.error("Telemetry history disabled for %s: %s", box, e)
 
-        self.httpConn = Domoticz.Connection(Name="cbox", Transport="TCP/IP", Protocol="HTTP", Address=Parameters["Address"], Port=Parameters["Port"])
-        self.httpConn.Connect()
-        
-        Domoticz.Heartbeat(10)
+    def openExport(self, box, now):
+        if self.options["export"] not in TelemetryExporter.EXTENSIONS:
+            log.error("Unknown export format: %s", self.options["export"])
+            return
+        box.exporter = TelemetryExporter(os.path.join(Parameters["HomeFolder"], "export-"+str(box.index + 1)), self.options["export"],
+                                         str(box), int(self.options["exportMaxBytes"]), int(self.options["exportKeep"]))
+        box.exportAt = now + self.options["exportFlush"]
+
+    def flushExport(self, box, now):
+        box.exportAt = now + self.options["exportFlush"]
+        if box.exporter.buffer:
+            worker.submit(None, box.exporter.write, box.exporter.take())
+
+    def recordHistory(self, box, state):
+        self.updateHistoryRow(box, state)
+        self.sampleHistory(box)
+
+    def updateHistoryRow(self, box, state):
+        row = box.historyRow
+        for field, value in state.items():
+            i = HISTORY_INDEX.get(field)
+            if i is not None:
+                try:
+                    row[i] = float(value)
+                except (TypeError, ValueError):
+                    log.event("History of %s: %s=%r is not a number", box, field, value)
 
+    def sampleHistory(self, box):
+        # one row per minute: a sample still waiting for the worker is replaced by the newer one
+        worker.submit(("history", box.index), box.history.sample, time.time(), list(box.historyRow))
 
     def onStop(self):
-        Domoticz.Debug("onStop called")
+        log.debug("onStop called")
+        if self.proxy is not None:
+            self.proxy.conn.Disconnect()
+            Domoticz.Log("Local proxy: "+str(self.proxy.requests)+" requests, "+str(self.proxy.cached)+" answered from the last poll")
+        if self.metrics is not None and self.debug:
+            self.dumpMetrics()
+        for box in self.boxes:
+            if box.pellets.changed:
+                self.savePellets(box, time.monotonic())
+            if box.exporter is not None:
+                self.flushExport(box, time.monotonic())
+            self.saveSnapshot(box, time.monotonic(), True)
+        if not worker.stop(10):
+            Domoticz.Error("Background worker still busy after 10 s")
+        Domoticz.Log("Background worker: "+str(worker.submitted)+" jobs, "+str(worker.coalesced)+" coalesced, "+
+                     str(worker.dropped)+" dropped, "+str(worker.failed)+" failed")
+        for box in self.boxes:
+            if box.exporter is not None:
+                Domoticz.Log(str(box)+": "+str(box.exporter.samples)+" samples exported in "+str(box.exporter.batches)+" writes")
+        for box in self.boxes:
+            if box.history is not None:
+                box.history.close()
+                box.history = None
+        if self.devices is not None:
+            Domoticz.Log("Device updates: "+str(self.devices.applied)+" applied, "+str(self.devices.skipped)+" skipped (unchanged)")
+        for box in self.boxes:
+            window = box.window
+            Domoticz.Log(str(box)+": "+str(window.answered)+" replies"+
+                         (", average round-trip time "+str(int(window.rtt * 1000))+" ms" if window.rtt is not None else "")+
+                         ", "+str(window.timeouts)+" timeouts, "+str(window.unexpected)+" unexpected replies, "+
+                         str(box.malformed)+" malformed replies, "+str(box.framingErrors)+" framing errors, "+
+                         str(box.assembler.fragments)+" fragments, "+str(box.assembler.dropped)+" incomplete replies dropped, "+
+                         str(box.decodeErrors)+" values not converted, "+
+                         str(box.pollHits)+" unchanged polls skipped, "+str(box.pollMisses)+" decoded")
 
     def onConnect(self, Connection, Status, Description):
+        box = self.boxesByName.get(Connection.Name)
+        if box is None:
+            return True
+
         if (Status == 0):
-            Domoticz.Debug("Connected successfully to "+Parameters["Address"]+":"+Parameters["Port"])
+            log.event("Connected successfully to %s", box)
+            box.link.onConnected(time.monotonic())
 
             # loop on pending commands                
-            while ( len( self.nextCommands ) > 0 ):
-              cmd = self.nextCommands.pop(0)
-              Domoticz.Debug("onConnect: cmd: " +cmd)
-              self.sendConnectionBoxCommand( cmd )    
+            self.sendPendingCommands(box)
             
         else:
-            Domoticz.Error("Failed to connect ("+str(Status)+") to: "+Parameters["Address"]+":"+Parameters["Port"]+" with error: "+Description)
+            log.error("Failed to connect (%s) to: %s with error: %s", Status, box, Description)
+            box.link.fail(time.monotonic())
+            self.onRequestsLost(box, box.window.clear())
 
         return True
 
 
     def onMessage(self, Connection, Data):
+        if "Verb" in Data:
+            # request of a client of the local proxy
+            if self.proxy is not None:
+                self.onProxyRequest(Connection, Data)
+            return True
+
+        box = self.boxesByName.get(Connection.Name)
+        if box is None:
+            return True
     
-        Response = json.loads( Data["Data"].decode("utf-8", "ignore") )
+        now = time.monotonic()
+        box.link.activity(now)
 
-        # JSON keys map to use
-        keys = None
-        if self.useNewLUA_API:
-            keys = self.__JSON_KEYS["lua"]
+        try:
+            body = box.assembler.feed(Data.get("Data"), Data.get("Headers"))
+        except ValueError as e:
+            # a transport glitch, not a reply of another API: the oldest request is lost, no API mismatch
+            box.framingErrors += 1
+            log.error("Bad reply framing from %s: %s", box, e)
+            request, lost = box.window.match(None, now)
+            if request is not None:
+                self.onRequestsLost(box, [request])
+            self.sendPendingCommands(box)
+            return True
+        if body is None:
+            # wait for the next fragments
+            return True
+
+        decoder = self.decoders[box.api]
+        ok = Data.get("Status", "200") == "200"
+        if ok and body == box.lastPollBody:
+            # byte-for-byte the previous poll reply: same tag, same values, no need to parse it
+            Response = None
+            tag, DataResponse = box.lastPollTag, None
         else:
-            keys = self.__JSON_KEYS["php"]
-
-        # TODO test if INFO_KEY in Response before trying to get the RSP value directly
-        # Assume that the result is a valid json response
-        if Response[keys["INFO_KEY"]]["RSP"] == "OK":
-
-            DataResponse = None
-            if "All Data" in Response:
-                DataResponse = Response["All Data"]
-            elif "DATA" in Response:
-                DataResponse = Response["DATA"]
-            elif "Setpoint" in Response:
-                DataResponse = Response["Setpoint"]
-            elif "Status" in Response:
-                DataResponse = Response["Status"]
-            elif "RoomFan" in Response:
-                DataResponse = Response["RoomFan"]
-            elif "Power" in Response:
-                DataResponse = Response["Power"]
-            elif "Counters" in Response:
-                DataResponse = Response["Counters"]
-            elif "Chrono Info" in Response:
-                DataResponse = Response["Chrono Info"]
-
-            # PELLET_QTUSED
-            if keys["PELLET_QTUSED"] in DataResponse:
-                UpdateDevice(self.__UNIT_PELLET_QTUSED, 0, str( DataResponse[keys["PELLET_QTUSED"]] ))
-
-            # ROOM Temperature
-            if keys["TMP_ROOM"] in DataResponse:
-                UpdateDevice(self.__UNIT_TMP_ROOM, 0, str( DataResponse[keys["TMP_ROOM"]] ))
-            
-            # TMP_PELLET_BACKW
-            if keys["TMP_PELLET_BACKW"] in DataResponse:
-                UpdateDevice(self.__UNIT_TMP_PELLET_BACKW, 0, str( DataResponse[keys["TMP_PELLET_BACKW"]] ))
-            
-            # TMP_EXHAUST
-            if keys["TMP_EXHAUST"] in DataResponse:
-                UpdateDevice(self.__UNIT_TMP_EXHAUST, 0, str( DataResponse[keys["TMP_EXHAUST"]] ))
-            
-            # Setpoint
-            if keys["SETP"] in DataResponse:
-                UpdateDevice(self.__UNIT_SETP, 0, str( DataResponse[keys["SETP"]] ))
-
-            # Status
-            if keys["STATUS"] in DataResponse:
-                self.status = int( DataResponse[keys["STATUS"]] )
-
-                # Update status code
-                Domoticz.Debug("Status code retrieved from cbox:"+str(self.status))
-                UpdateDevice(self.__UNIT_STATUS, 3, str(self.status))
-
-                # update onStatus and On/Off Switch according to status code
-                if (self.status >= 2 and self.status <= 12):
-                    self.onStatus = 1
-                    UpdateDevice(self.__UNIT_ONOFF, 1, str("On"))
-                else:
-                    self.onStatus = 0
-                    UpdateDevice(self.__UNIT_ONOFF, 0, str("Off"))
+            Response = parseReply(body) if ok else None
+            if Response is None or decoder.infoKey not in Response:
+                # the reply answers the oldest request, which failed: the box may not speak this API
+                box.malformed += 1
+                log.event("Malformed reply (%s, %d bytes) from %s", Data.get("Status"), len(body), box)
+                request, lost = box.window.match(None, now)
+                if request is not None:
+                    self.onApiMismatch(box, request)
+                    self.onRequestsLost(box, [request])
+                self.sendPendingCommands(box)
+                return True
+            tag, DataResponse = decoder.payload(Response)
 
-                # Update status label
-                UpdateDevice(self.__UNIT_STATUSLABEL, 0, self.statusCodes.get(str(self.status)))
-          
-          
-            # RoomFan
-            if keys["FAN_FAN2LEVEL"] in DataResponse:
-                newRoomFanLevel = int( DataResponse[keys["FAN_FAN2LEVEL"]] )
-
-                Domoticz.Debug("Fan Speed retrieved from cbox:"+str(newRoomFanLevel))
-                if ( newRoomFanLevel >= 1 ) and (newRoomFanLevel <= 5): # 1 to 5
-                    value = int(newRoomFanLevel * 10)
-                    UpdateDevice(self.__UNIT_FAN2LEVEL, self.onStatus, str(value))
-                elif ( newRoomFanLevel == 7 ): # OFF
-                    UpdateDevice(self.__UNIT_FAN2LEVEL, 0, 0)
-                elif ( newRoomFanLevel == 0 ): # Auto
-                    UpdateDevice(self.__UNIT_FAN2LEVEL, self.onStatus, 60)
-                elif ( newRoomFanLevel == 6 ): # HI
-                    UpdateDevice(self.__UNIT_FAN2LEVEL, self.onStatus, 70)
-
-            # Power level
-            if keys["POWER"] in DataResponse:
-                newPowerLevel = int( DataResponse[keys["POWER"]] )
-
-                Domoticz.Debug("Power level retrieved from cbox:"+str(newPowerLevel))
-                if ( newPowerLevel >= 1 ) and (newPowerLevel <= 5): # 1 to 5
-                    value = int(newPowerLevel * 10)
-                    UpdateDevice(self.__UNIT_POWER, self.onStatus, str(value))
-                else:
-                    Domoticz.Error("Unknown power value:"+str(newPowerLevel))
+        # find the request answered
+        request, lost = box.window.match(tag, now)
+        if lost:
+            self.onRequestsLost(box, lost)
+        if request is None:
+            log.event("Dropping unexpected reply (%s) from %s", tag, box)
+            return True
 
-            # Chrono Info
-            if keys["CHRSTATUS"] in DataResponse:
-                newChronoInfo = int( DataResponse[keys["CHRSTATUS"]] )
+        isPoll = request.command == "GET+ALLS"
+        if isPoll:
+            if request.seq < box.lastPollSeq:
+                log.event("Dropping stale poll reply from %s", box)
+                return True
+            box.lastPollSeq = request.seq
 
-                Domoticz.Debug("Chrono info retrieved from cbox:"+str(newChronoInfo))
-                if (newChronoInfo == 1):
-                    UpdateDevice(self.__UNIT_TIMER_ONOFF, 1, str("On"))
+        if self.proxy is not None:
+            self.proxy.answer(box, request.command, body)
+
+        if Response is None:
+            log.event("Unchanged poll reply from %s", box)
+            if box.exporter is not None:
+                box.exporter.add(time.time(), box.lastPollData)
+            box.attempts.pop(request.command, None)
+            box.link.replied()
+            box.lastSeen = now
+            box.lastPollAt = now
+            box.pollsOK += 1
+            box.pollHits += 1
+            self.onPollUnchanged(box, now)
+
+        elif decoder.isOK(Response):
+            box.attempts.pop(request.command, None)
+            box.link.replied()
+            box.lastSeen = now
+            box.mismatches = 0
+            if box.optimistic:
+                self.confirmOptimistic(box, request.command)
+            if request.command == "GET+CHRD" or commandName(request.command) in INDEXED_COMMANDS:
+                self.onChronoReply(box, request.command, DataResponse)
+                if request.command == "GET+CHRD" and box.chronoEdit is not None:
+                    self.onChronoRefreshed(box)
+
+            if isPoll:
+                box.pollsOK += 1
+                box.lastPollAt = now
+            if isPoll and DataResponse is not None:
+                box.lastPollBody = body
+                box.lastPollTag = tag
+                box.lastPollData = DataResponse
+                if box.exporter is not None:
+                    box.exporter.add(time.time(), DataResponse)
+                if box.probing or decoder.firmware(DataResponse) != box.firmware:
+                    self.onApiConfirmed(box, decoder, DataResponse)
+                # the LUA API stamps each reply: compare the mapped fields only
+                fingerprint = decoder.fingerprint(DataResponse)
+                if fingerprint == box.lastFingerprint:
+                    log.event("Unchanged poll reply from %s", box)
+                    box.pollHits += 1
+                    self.onPollUnchanged(box, now)
+                    DataResponse = None
                 else:
-                    UpdateDevice(self.__UNIT_TIMER_ONOFF, 0, str("Off"))
-            # else:
-            # TODO what was the reason for Updating TIMER_ONOFF based on status ?!?
-            #     if ( self.status == 0):
-            #         UpdateDevice(self.__UNIT_TIMER_ONOFF, 0, str("Off"))
-            #     elif ( self.status == 1):
-            #         UpdateDevice(self.__UNIT_TIMER_ONOFF, 1, str("On"))
+                    box.pollMisses += 1
+                    box.lastFingerprint = fingerprint
+
+            if DataResponse is not None:
+                errors = decoder.errors
+                state = decoder.decode(DataResponse)
+                if decoder.errors != errors:
+                    # the decoders are shared by the boxes of an API: count this box's share
+                    box.decodeErrors += decoder.errors - errors
+                    log.event("%d value(s) from %s not converted, ignored", decoder.errors - errors, box)
+
+                if isPoll:
+                    if box.written:
+                        self.dropOverwritten(box, request, state)
+                elif state and not request.command.startswith("GET+"):
+                    # the reply of a command is the new state: read-your-writes for the older polls
+                    for field in state:
+                        box.written[field] = request.seq
+                    # CMD+ON/OFF start a sequence of status changes that is worth polling fast
+                    box.scheduler.commandApplied(now, commandFamily(request.command) == "CMD")
+                # logged once complete: the worker formats it later, state is not changed after this point
+                log.event("Decoded from %s (%s): %s", box, request.command, state)
+
+                if not box.reported.issuperset(state):
+                    self.createReportedDevices(box, state)
+                box.stove.update(state)
+
+                targets = self.targets
+                for field, value in state.items():
+                    for unit, handler, formatter in targets[field]:
+                        if handler is None:
+                            self.devices.stage(box.unit(unit), 0, formatter(value))
+                        else:
+                            handler(box, unit, value)
+
+                if box.optimistic:
+                    self.holdOptimistic(box)
+
+                self.devices.flush(self.debug)
+
+                if box.history is not None:
+                    self.recordHistory(box, state)
 
         # NO RSP: OK response          
         else:
-            Domoticz.Error("Error in Connection Box response: "+str(Status))
+            log.error("Error in Connection Box response to %s: %s", request.command, Response.get(decoder.infoKey))
+            self.onRequestsLost(box, [request])
 
+        # the window has room for the next commands
+        self.sendPendingCommands(box)
         return True 
+
+    def dropOverwritten(self, box, request, state):
+        # a poll sent before a command cannot overwrite the value given by the reply of the command
+        for field, seq in list(box.written.items()):
+            if request.seq < seq:
+                if state.pop(field, None) is not None:
+                    log.event("Ignoring %s of a poll older than the last command to %s", field, box)
+                    # this reply is not the state of the box: the next one has to be decoded in full
+                    box.forgetPoll()
+            else:
+                del box.written[field]
+
+    def updateOptimistically(self, box, unit, command, nValue, sValue):
+        # show the new value at once, and send the command: the value is confirmed by its reply, or rolled back
+        family = commandFamily(command)
+        entry = box.optimistic.get(family)
+        if entry is None:
+            box.optimistic[family] = [unit, self.devices.values.get(box.unit(unit)), command]
+        else:
+            # a newer value of the same kind: the last confirmed value does not change
+            entry[2] = command
+        self.devices.stage(box.unit(unit), nValue, sValue)
+        self.devices.flush(self.debug)
+        self.queueCommand(box, command)
+
+    def confirmOptimistic(self, box, command):
+        family = commandFamily(command)
+        entry = box.optimistic.get(family)
+        if entry is not None and entry[2] == command:
+            del box.optimistic[family]
+
+    def holdOptimistic(self, box):
+        # the value shown for a command waiting for its reply is not overwritten by a poll (or an older command):
+        # the polled value becomes the value to restore if the command fails
+        for entry in box.optimistic.values():
+            value = self.devices.unstage(box.unit(entry[0]))
+            if value is not None:
+                entry[1] = value
+
+    def rollbackOptimistic(self, box, command, reason = "was not applied"):
+        """The command failed: restore the last confirmed value of its device. Returns False if there was none to restore"""
+        family = commandFamily(command)
+        entry = box.optimistic.get(family)
+        if entry is None or entry[2] != command:
+            return False
+        del box.optimistic[family]
+        # the next poll tells the actual value
+        box.forgetPoll()
+        if entry[1] is None:
+            return False
+        self.devices.stage(box.unit(entry[0]), entry[1][0], entry[1][1])
+        self.devices.flush(self.debug)
+        log.error("Command %s to %s %s, device restored to %s", command, box, reason, entry[1][1])
+        return True
+
+    def onPollUnchanged(self, box, now):
+        # nothing to decode, but the time based estimations go on
+        if box.pellets.counter is not None:
+            self.samplePellets(box, now, box.pellets.counter)
+            self.devices.flush(self.debug)
+        if box.history is not None:
+            self.sampleHistory(box)
+
+    def samplePellets(self, box, now, counter):
+        if box.status == STATUS_NOPELLET:
+            box.pellets.empty()
+        box.pellets.sample(now, counter, box.power, box.status in BURNING_STATUS)
+        self.updatePellets(box, now)
+
+    def onStatusDecoded(self, box, unit, status):
+        if status != box.status:
+            log.event("%s: status %s -> %s", box, box.status, status)
+        box.status = status
+        box.scheduler.statusUpdated(box.status, time.monotonic())
+        box.onStatus = 1 if isRunning(box.status) else 0
+
+        # Update status code
+        self.devices.stage(box.unit(unit), 3, str(box.status))
+
+    def onOnOffDecoded(self, box, unit, status):
+        # update On/Off Switch according to status code
+        if box.onStatus:
+            self.devices.stage(box.unit(unit), 1, "On")
+        else:
+            self.devices.stage(box.unit(unit), 0, "Off")
+
+    def onStatusLabelDecoded(self, box, unit, status):
+        self.devices.stage(box.unit(unit), 0, self.statusLabel(status))
+
+    def onLastAlarmDecoded(self, box, unit, status):
+        if status >= ALARM_STATUS:
+            self.devices.stage(box.unit(unit), 0, self.statusLabel(status))
+
+    def onAlarmDecoded(self, box, unit, status):
+        # one event per alarm: when the stove enters it, and when it leaves it
+        alarm = status if status >= ALARM_STATUS else None
+        if alarm != box.alarm:
+            if box.alarm is not None:
+                Domoticz.Status(str(box)+": "+self.statusLabel(box.alarm)+" cleared")
+            if alarm is not None:
+                # also logs the recent events
+                log.error("%s: %s (status %d)", box, self.statusLabel(alarm), alarm)
+            box.alarm = alarm
+
+        # Alert device: red during an alarm, green otherwise (the Domoticz notifications of the device tell the event)
+        if alarm is not None:
+            self.devices.stage(box.unit(unit), 4, self.statusLabel(alarm))
+        else:
+            self.devices.stage(box.unit(unit), 1, "No alarm")
+
+    def statusLabel(self, status):
+        return statusLabel(status, self.statusCodes, self.alarmCodes)
+
+    def onPelletCounterDecoded(self, box, unit, counter):
+        self.samplePellets(box, time.monotonic(), counter)
+
+    def onFanLevelDecoded(self, box, unit, newRoomFanLevel):
+        if ( newRoomFanLevel >= 1 ) and (newRoomFanLevel <= 5): # 1 to 5
+            value = int(newRoomFanLevel * 10)
+            self.devices.stage(box.unit(unit), box.onStatus, str(value))
+        elif ( newRoomFanLevel == FAN_OFF ):
+            self.devices.stage(box.unit(unit), 0, 0)
+        elif ( newRoomFanLevel == FAN_AUTO ):
+            self.devices.stage(box.unit(unit), box.onStatus, 60)
+        elif ( newRoomFanLevel == FAN_HI ):
+            self.devices.stage(box.unit(unit), box.onStatus, 70)
+
+    def onPowerLevelDecoded(self, box, unit, newPowerLevel):
+        if ( newPowerLevel >= 1 ) and (newPowerLevel <= 5): # 1 to 5
+            box.power = newPowerLevel
+            value = int(newPowerLevel * 10)
+            self.devices.stage(box.unit(unit), box.onStatus, str(value))
+        else:
+            log.error("Unknown power value:%s", newPowerLevel)
+
+    def onChronoStatusDecoded(self, box, unit, newChronoInfo):
+        if (newChronoInfo == 1):
+            self.devices.stage(box.unit(unit), 1, "On")
+        else:
+            self.devices.stage(box.unit(unit), 0, "Off")
     
     #    
     # Called when a command is received from Domoticz. The Unit parameters matches the Unit specified in the device definition and should be used to map commands
@@ -354,7 +2235,25 @@ class BasePlugin:
     # used to send Domoticz commands to the external hardware. 
     #
     def onCommand(self, Unit, Command, Level, Hue):
-        Domoticz.Debug("onCommand called for Unit " + str(Unit) + ": Command '" + str(Command) + "', Level: " + str(Level) + ", Connected: " + str(self.httpConn.Connected()))
+        boxIndex = Unit // UNITS_PER_BOX
+        if boxIndex >= len(self.boxes):
+            log.error("onCommand called for Unit %d that belongs to no Connection Box", Unit)
+            return True
+        box = self.boxes[boxIndex]
+        Unit = Unit - box.unitBase
+
+        if (Unit == self.__UNIT_PELLET_REFILL): # Pellets refilled push button, nothing to send to the box
+            box.pellets.refill(self.options["refillKg"])
+            Domoticz.Log(str(box)+": hopper refilled, "+("%.1f" % box.pellets.remaining)+" kg of pellets")
+            now = time.monotonic()
+            self.updatePellets(box, now)
+            self.savePellets(box, now)
+            self.devices.flush(self.debug)
+            return True
+
+        self.commandFromUser(box)
+
+        log.event("onCommand called for Unit %d of %s: Command '%s', Level: %s, Connection: %s", Unit, box, Command, Level, box.link.state)
         
         Command = Command.strip()
         action, sep, params = Command.partition(' ')
@@ -365,193 +2264,310 @@ class BasePlugin:
             if (int(Level) >= 10 ) and  (int(Level) <= 50): # 1, 2, 3, 4, 5
                 fanLevel = int(int(Level) / 10)  
             elif (int(Level) == 0): # Off
-                fanLevel = 7
+                fanLevel = FAN_OFF
             elif (int(Level) == 60): # Auto
-                fanLevel = 0
+                fanLevel = FAN_AUTO
             elif (int(Level) == 70): # Hi
-                fanLevel = 6
+                fanLevel = FAN_HI
                
-            Domoticz.Debug("Setting new fan speed:"+str(fanLevel))
-            cmd = "SET+RFAN+"+str(fanLevel)
-            self.sendConnectionBoxCommand(cmd)
+            log.debug("Setting new fan speed:%d", fanLevel)
+            self.updateOptimistically(box, Unit, fanCommand(fanLevel), box.onStatus if fanLevel != FAN_OFF else 0, str(int(Level)))
             
         elif (Unit == self.__UNIT_POWER): # Power Level Selector Switch
             powerLevel = int(int(Level) / 10)
-            Domoticz.Debug("Setting new power level:"+str(powerLevel))
-            cmd = "SET+POWR+"+str(powerLevel)
-            self.sendConnectionBoxCommand(cmd)
+            log.debug("Setting new power level:%d", powerLevel)
+            try:
+                cmd = powerCommand(powerLevel)
+            except ValueError as e:
+                log.error("%s", e)
+                return True
+            self.updateOptimistically(box, Unit, cmd, box.onStatus, str(powerLevel * 10))
             
         elif (Unit == self.__UNIT_ONOFF): # On/Off Switch
             if (action == 'Off'):
-              Domoticz.Debug("Switching Off")
-              self.onStatus = 0
-              # UpdateDevice(self.__UNIT_ONOFF, 0, str("Off"))
-              cmd = "CMD+OFF"
-              self.sendConnectionBoxCommand(cmd)
+              log.debug("Switching Off")
+              box.onStatus = 0
+              self.updateOptimistically(box, Unit, switchCommand(False), 0, "Off")
             elif (action == 'On'):
-              Domoticz.Debug("Switching On")
-              self.onStatus = 1
-              # UpdateDevice(self.__UNIT_ONOFF, 1, str("On"))
-              cmd = "CMD+ON"
-              self.sendConnectionBoxCommand(cmd)
+              log.debug("Switching On")
+              box.onStatus = 1
+              self.updateOptimistically(box, Unit, switchCommand(True), 1, "On")
             return True
         
         elif (Unit == self.__UNIT_SETP): # Setpoint
             # (ConnectionBox) onCommand called for Unit 4: Command 'Set Level', Level: 20.0, Connected: False
             newSetpoint = int(Level)  # convert into integer to round float
-            Domoticz.Debug("onCommand with new Setpoint:"+str(newSetpoint))
-            cmd = "SET+SETP+"+str(newSetpoint)
-            self.sendConnectionBoxCommand(cmd)
+            log.debug("onCommand with new Setpoint:%d", newSetpoint)
+            try:
+                cmd = setpointCommand(newSetpoint)
+            except ValueError as e:
+                log.error("%s", e)
+                return True
+            self.updateOptimistically(box, Unit, cmd, 0, str(newSetpoint))
             
         elif (Unit == self.__UNIT_TIMER_ONOFF): # Timer On/Off Switch
             if (action == 'Off'):
-              Domoticz.Debug("Switching Timer Off")
-              UpdateDevice(self.__UNIT_TIMER_ONOFF, 0, str("Off"))
-              cmd = "SET+CSST+0"
-              self.sendConnectionBoxCommand(cmd)
+              log.debug("Switching Timer Off")
+              self.updateOptimistically(box, Unit, chronoCommand(False), 0, "Off")
             elif (action == 'On'):
-              Domoticz.Debug("Switching Timer On")
-              UpdateDevice(self.__UNIT_TIMER_ONOFF, 1, str("On"))
-              cmd = "SET+CSST+1"
-              self.sendConnectionBoxCommand(cmd)
+              log.debug("Switching Timer On")
+              self.updateOptimistically(box, Unit, chronoCommand(True), 1, "On")
               
         return True
 
 
     def onNotification(self, Name, Subject, Text, Status, Priority, Sound, ImageFile):
-        Domoticz.Debug("Notification: " + Name + "," + Subject + "," + Text + "," + Status + "," + str(Priority) + "," + Sound + "," + ImageFile)
+        log.debug("Notification: %s,%s,%s,%s,%s,%s,%s", Name, Subject, Text, Status, Priority, Sound, ImageFile)
 
 
     def onDisconnect(self, Connection):
-        Domoticz.Debug("Device "+Parameters["Address"]+":"+Parameters["Port"]+" has disconnected")
+        box = self.boxesByName.get(Connection.Name)
+        if box is None and self.proxy is not None:
+            self.proxy.forget(Connection)
+        if box is not None:
+            log.event("Device %s has disconnected", box)
+            box.link.onDisconnected()
+            box.assembler.reset()
+            # requests without reply will never be answered
+            self.onRequestsLost(box, box.window.clear())
         return
 
 
     def onHeartbeat(self):
         
-        self.nextConnect = self.nextConnect - 1
-        
-        if (self.nextConnect <= 0):
-            self.nextConnect = 6
-            self.updateConnectionBoxStatus()
+        # each box has its own poll schedule, so that a dead box does not delay the others
+        now = time.monotonic()
+        if self.metrics is not None and now >= self.metrics.nextPublish:
+            self.publishMetrics(now)
+        if self.proxy is not None and self.proxy.waiters:
+            self.proxy.expire(now)
+        if now >= self.snapshotAt:
+            self.snapshotAt = now + self.options["snapshotPeriod"]
+            for box in self.boxes:
+                self.saveSnapshot(box, now)
+        for box in self.boxes:
+            if box.exporter is not None and now >= box.exportAt:
+                self.flushExport(box, now)
+            link = box.link
+            if box.commands.userLane:
+                expired = box.commands.expire(now)
+                if expired:
+                    self.onCommandsExpired(box, expired)
+            if box.window.expired(now):
+                # the replies come in order: the connection is stuck, start again with a new one after a while
+                box.window.timeouts += 1
+                log.error("No reply from %s to %s within %ss", box, box.window.requests[0].command, box.window.timeout)
+                link.fail(now)
+                # one failure per timeout: the requests will not be answered on the connection being closed
+                self.onRequestsLost(box, box.window.clear())
+
+            if box.scheduler.isDue(now):
+                box.scheduler.polled(now)
+                self.updateConnectionBoxStatus(box)
+            elif len(box.commands) > 0:
+                # debounced commands, or commands waiting for the end of a back-off
+                self.sendPendingCommands(box)
+            elif not link.isConnected():
+                # connect early, so that the next poll goes out at once
+                if box.scheduler.nextPoll - now <= self.options["connectLead"]:
+                    link.connect(now)
+            elif box.status == STATUS_OFF and len(box.window) == 0 and link.idleFor(now) >= self.options["idleTimeout"]:
+                # no need to keep a socket open on the box while the stove is OFF
+                log.event("Closing idle connection to %s", box)
+                link.close()
             
         return True
-            
-#         if self.httpConn.Connected():
-#             # updates
-#             if ( self.oustandingPings == 1 or self.oustandingPings == 12 ):
-#               Domoticz.Debug("Connection is up for 30s now, time to get an update")
-#               self.sendConnectionBoxStatusCommands()
-#               self.oustandingPings = self.oustandingPings + 1
-#               
-#             # forcing disconnect after 3*20 sec
-#             elif (self.oustandingPings > 20):
-#                 Domoticz.Debug("Forcing to disconnect")
-#                 self.httpConn.Disconnect()
-#                 self.nextConnect = 0
-# 
-#             else:
-#                 Domoticz.Debug("Sending /null pings")
-#                 data = ''
-#                 headers = { 'Content-Type': 'text/xml; charset=utf-8', \
-#                             'Connection': 'keep-alive', \
-#                             'Accept': 'Content-Type: text/html; charset=UTF-8', \
-#                             'Host': Parameters["Address"]+":"+Parameters["Port"], \
-#                             'User-Agent':'Domoticz/1.0', \
-#                             'Content-Length' : "%d"%(len(data)) }
-#                 # self.httpConn.Send(data, 'GET', '/null', headers)
-#                 self.oustandingPings = self.oustandingPings + 1
-#             
-#         else:
-#             # if not connected try and reconnects every 3 heartbeats
-#             self.oustandingPings = 0
-#             self.nextConnect = self.nextConnect - 1
-#             if (self.nextConnect <= 0):
-#                 self.nextConnect = 3
-#                 self.httpConn.Connect()
-#         return True
         
-    def updateConnectionBoxStatus(self):
-    
-        if self.httpConn.Connected():
-            self.sendConnectionBoxCommand("GET+ALLS", False)
+    def updateConnectionBoxStatus(self, box):
+        now = time.monotonic()
+        # a poll still waiting for its reply is not overlapped by the next one
+        if not box.window.has("GET+ALLS"):
+            box.commands.push("GET+ALLS", False, now)
 
-            # no need for CHRD with new API because Chrono status info is returned part of GET+ALLS cmd
-            if not self.useNewLUA_API:
-                self.sendConnectionBoxCommand("GET+CHRD", False)
+        # no need for CHRD when the Chrono status info is returned part of GET+ALLS cmd,
+        # unless the cached chrono program has to be downloaded
+        if self.needsChronoPoll(box) and not box.window.has("GET+CHRD"):
+            box.commands.push("GET+CHRD", False, now)
 
-        else:
-            self.nextCommands.append("GET+ALLS")
+        self.sendPendingCommands(box)
+      
 
-            # no need for CHRD with new API because Chrono status info is returned part of GET+ALLS cmd
-            if not self.useNewLUA_API:
-                self.nextCommands.append("GET+CHRD")
+    def commandFromUser(self, box):
+        # poll fast for a while to get the confirmation, and decode the next poll in full
+        box.scheduler.commandSent(time.monotonic())
+        box.forgetPoll()
 
-            self.httpConn.Connect()
-      
+    def onProxyRequest(self, Connection, Data):
+        proxy = self.proxy
+        proxy.requests += 1
+        now = time.monotonic()
+        box, path, command, parameters = proxy.parse(Data.get("URL", "/"), self.boxes)
+        error = None
+        if command is not None:
+            try:
+                # rebuilt with the encoders: a value the plugin would not send itself never reaches the box
+                command = checkCommand(command)
+            except ValueError as e:
+                error = str(e)
+        if box is None:
+            proxy.send(Connection, "404 Not Found", b'{"error": "no such Connection Box"}')
+
+        elif path == "state":
+            state = { "address": str(box), "status": self.statusLabel(box.status),
+                      "connection": box.link.state, "age": None if box.lastSeen is None else round(now - box.lastSeen, 1),
+                      "fields": box.stove.fields() }
+            proxy.send(Connection, "200 OK", json.dumps(state).encode("utf-8"))
+
+        elif path == "chrono":
+            status, reply = self.onChronoRequest(box, parameters)
+            proxy.send(Connection, status, json.dumps(reply).encode("utf-8"))
+
+        elif path == "history":
+            status, reply = self.onHistoryRequest(box, parameters)
+            proxy.send(Connection, status, json.dumps(reply).encode("utf-8"))
+
+        elif not (path.endswith("sendmsg.lua") or path.endswith("sendmsg.php")) or command is None:
+            proxy.send(Connection, "404 Not Found", b'{"error": "unknown request"}')
+
+        elif error is not None:
+            proxy.send(Connection, "400 Bad Request", json.dumps({ "error": error }).encode("utf-8"))
+
+        elif command == "GET+ALLS" and box.lastPollBody is not None and now - box.lastPollAt <= proxy.ttl:
+            # one poll of the plugin serves every consumer
+            proxy.cached += 1
+            proxy.send(Connection, "200 OK", box.lastPollBody)
 
-    def sendConnectionBoxCommand(self, command, prio = True):
-        if self.httpConn.Connected():
-            Domoticz.Debug("onHeartbeat called, Connection is alive.")
-            
-            data = ''
-            headers = { 'Content-Type': 'text/xml; charset=utf-8', \
-                        'Connection': 'keep-alive', \
-                        'Accept': 'Content-Type: text/html; charset=UTF-8', \
-                        'Host': Parameters["Address"]+":"+Parameters["Port"], \
-                        'User-Agent':'Domoticz/1.0', \
-                        'Content-Length' : "%d"%(len(data)) }
-
-            sendData = { 'Verb' : 'GET',
-                         'URL'  : self.API_URI+'?cmd='+command,
-                         'Headers' : headers
-                       }
-            self.httpConn.Send(sendData)
-            
-            
         else:
-            if ( self.nextCommands.count(command) == 0 ):
-                if prio:
-                    self.nextCommands.insert(0, command)
-                    Domoticz.Debug("Command "+command+" added(insert) by sendConnectionBoxCommand")
-                else:
-                    self.nextCommands.append(command)
-                    Domoticz.Debug("Command "+command+" added(append) by sendConnectionBoxCommand")
-            
-            if not self.httpConn.Connecting(): 
-              self.httpConn.Connect()
+            log.event("Proxy request %s for %s", command, box)
+            proxy.wait(box, command, Connection, now)
+            if command == "GET+ALLS":
+                self.updateConnectionBoxStatus(box)
+            elif command.startswith("GET+"):
+                if not box.window.has(command):
+                    box.commands.push(command, False, now)
+                self.sendPendingCommands(box)
+            else:
+                self.commandFromUser(box)
+                self.queueCommand(box, command)
+
+    def queueCommand(self, box, command, prio = True):
+        box.commands.push(command, prio, time.monotonic())
+        log.debug("Command %s queued, %d pending command(s)", command, len(box.commands))
+        self.sendPendingCommands(box)
+
+
+    def sendPendingCommands(self, box):
+        now = time.monotonic()
+        if box.link.isConnected():
+            while not box.window.isFull():
+                command = box.commands.pop(now)
+                if command is None:
+                    break
+                self.sendConnectionBoxCommand(box, command, now)
+
+        elif len(box.commands) > 0:
+            box.link.connect(now)
+
+
+    def onRequestsLost(self, box, requests):
+        now = time.monotonic()
+        for request in requests:
+            # only GET commands are retried: they have no effect on the stove
+            if request.command.startswith("GET+") and request.attempt < self.options["retries"]:
+                box.attempts[request.command] = request.attempt + 1
+                delay = self.options["retryBackoff"] * (2 ** request.attempt)
+                log.event("Retrying %s to %s in %ss", request.command, box, delay)
+                box.commands.push(request.command, False, now, delay)
+            else:
+                box.attempts.pop(request.command, None)
+                if self.proxy is not None:
+                    self.proxy.fail(box, request.command)
+                if commandName(request.command) in INDEXED_COMMANDS:
+                    self.onChronoCommandLost(box, request.command)
+                if request.command == "GET+CHRD" and box.chronoEdit is not None:
+                    box.chronoEdit = None
+                    log.error("Chrono edit of %s dropped: program not downloaded", box)
+                if not request.command.startswith("GET+") and not self.rollbackOptimistic(box, request.command):
+                    log.error("Command %s to %s may not have been applied", request.command, box)
+
+    def onCommandsExpired(self, box, commands):
+        # never sent: the devices show values that did not take effect
+        for command in commands:
+            box.attempts.pop(command, None)
+            if self.proxy is not None:
+                self.proxy.fail(box, command)
+            if commandName(command) in INDEXED_COMMANDS:
+                self.onChronoCommandLost(box, command)
+            if not self.rollbackOptimistic(box, command):
+                log.error("Command %s to %s was not sent within %ss, dropped", command, box, box.commands.timeout)
+
+    def sendConnectionBoxCommand(self, box, command, now):
+        log.event("Sending %s to %s", command, box)
+        if command == "GET+ALLS":
+            box.pollsSent += 1
+        box.window.sent(command, self.decoders[box.api].expectedTags(command), now, box.attempts.get(command, 0))
+        box.link.activity(now)
+        box.httpConn.Send({ 'Verb' : 'GET',
+                            'URL'  : box.urlPrefix+command,
+                            'Headers' : box.headers })
             
             
+    def updateOptions(self, optionsStr):
+        if optionsStr.strip() == "":
+            return
+
+        optionsDict = None
+        try:
+           optionsDict = ast.literal_eval(optionsStr)
+        except:
+          log.error("Bad syntax for advanced options:%s", optionsStr)
+
+        if not isinstance(optionsDict, dict):
+          return
+
+        for name, value in optionsDict.items():
+          if name not in self.options:
+            log.error("Unknown advanced option: %s", name)
+          elif not isOptionValueValid(self.options[name], value):
+            log.error("Bad value for advanced option %s: %s", name, value)
+          else:
+            self.options[name] = value
+            log.debug("Advanced option %s: %s", name, value)
+
+        if self.options["fastPoll"] < HEARTBEAT:
+          self.options["fastPoll"] = HEARTBEAT
+
     def updateCustomStatusCodes(self, customCodesStr):
         customCodesDict = None
         try:
            customCodesDict = ast.literal_eval(customCodesStr)
         except:
-          Domoticz.Error("Bad syntax for custom codes:"+customCodesStr)
+          log.error("Bad syntax for custom codes:%s", customCodesStr)
           
-        if customCodesDict == None:
+        if not isinstance(customCodesDict, dict):
           return
         
         for code, newValue in customCodesDict.items():
-          Domoticz.Debug("custom label for: "+code)
+          log.debug("custom label for: %s", code)
           found = False
           
           for key, value in self.statusCodes.items():
             if ( code == key ):
               found = True
-              Domoticz.Debug("Code "+code+" found in built-in codes map as key")
+              log.debug("Code %s found in built-in codes map as key", code)
               self.statusCodes[key] = newValue
             elif ( code == value ):
               found = True
-              Domoticz.Debug("Code "+code+" found in built-in codes map as value")
+              log.debug("Code %s found in built-in codes map as value", code)
               self.statusCodes[key] = newValue
               
           if ( not found ):
-            Domoticz.Debug("Code "+code+" NOT found in built-in codes map")
+            log.debug("Code %s NOT found in built-in codes map", code)
         
-        Domoticz.Debug("### Final dict of codes ####")
-        for key, value in self.statusCodes.items():
-          Domoticz.Debug("key: "+key+":"+value)                  
+        if log.debugging:
+          log.debug("### Final dict of codes ####")
+          for key, value in self.statusCodes.items():
+            log.debug("key: %s:%s", key, value)
     
 
 global _plugin
@@ -639,17 +2655,12 @@ def DumpConfigToLog2():
         Domoticz.Debug("Device Image.........: " + str(Devices[x].Image))
     return
 
-def UpdateDevice(Unit, nValue, sValue):
-    # Make sure that the Domoticz device still exists (they can be deleted) before updating it 
-    if (Unit in Devices):
-        if (Devices[Unit].nValue != nValue):
-            Devices[Unit].Update(nValue=nValue, sValue=str(sValue))
-            Domoticz.Debug("Update "+str(nValue)+":'"+str(sValue)+"' ("+Devices[Unit].Name+") due to different in nValue")
-        elif ( str(Devices[Unit].sValue) != str(sValue) ):
-            Devices[Unit].Update(nValue=nValue, sValue=str(sValue))
-            Domoticz.Debug("Update "+str(nValue)+":'"+str(sValue)+"' ("+Devices[Unit].Name+") due to different in sValue")
-    return
-    
+def isOptionValueValid(default, value):
+    # numbers must be positive, other options keep the type of their default value
+    if type(default) in (int, float):
+        return type(value) in (int, float) and value >= 0
+    return type(value) == type(default)
+
 def DumpHTTPResponseToLog(httpDict):
     if isinstance(httpDict, dict):
         Domoticz.Log("HTTP Details ("+str(len(httpDict))+"):")
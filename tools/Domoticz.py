@@ -0,0 +1,251 @@
+# Fake Domoticz module, to run the plugin outside of Domoticz (benchmarks, simulator)
+#
+# Only the part of the Domoticz Python plugin API used by the plugin is covered.
+# Connections are real TCP connections talking HTTP/1.1 (keep-alive) from a thread per connection:
+# the callbacks (onConnect, onMessage, onDisconnect) are queued and delivered by runCallbacks(), on the caller thread,
+# like Domoticz delivers them on the plugin thread.
+# Listening HTTP connections are served by a threaded HTTP server: each incoming request is delivered as an onMessage
+# with Verb and URL, on a new connection with the name of the listening one, and waits for the Send of the plugin.
+#
+import queue
+import threading
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+Devices = {}
+Parameters = {}
+Settings = {}
+Images = {}
+
+debugging = False
+heartbeat = 10
+quiet = False
+
+# when > 0, reply bodies are delivered in several onMessage calls of this size (only the first one has Status and Headers)
+fragmentSize = 0
+
+# counters, for the benchmarks
+stats = { "Debug": 0, "Log": 0, "Error": 0, "Update": 0, "Create": 0, "Send": 0 }
+
+# (callback name, args) waiting to be delivered to the plugin
+events = queue.Queue()
+
+def Debugging(mask):
+    global debugging
+    debugging = (mask != 0)
+
+def Debug(message):
+    stats["Debug"] += 1
+    if debugging and not quiet:
+        print("Debug: "+message)
+
+def Log(message):
+    stats["Log"] += 1
+    if not quiet:
+        print("Log: "+message)
+
+def Status(message):
+    stats["Log"] += 1
+    if not quiet:
+        print("Status: "+message)
+
+def Error(message):
+    stats["Error"] += 1
+    if not quiet:
+        print("Error: "+message)
+
+def Heartbeat(interval):
+    global heartbeat
+    heartbeat = interval
+
+def reset():
+    """Forget devices, parameters and pending callbacks"""
+    Devices.clear()
+    Parameters.clear()
+    for name in stats:
+        stats[name] = 0
+    while not events.empty():
+        events.get_nowait()
+
+def setup(module, parameters):
+    """Give a plugin module the globals that Domoticz would inject"""
+    Parameters.update(parameters)
+    module.Parameters = Parameters
+    module.Devices = Devices
+    module.Settings = Settings
+    module.Images = Images
+
+def queueMessage(connection, status, headers, data):
+    """Queue an onMessage callback, fragmented according to fragmentSize"""
+    size = fragmentSize if fragmentSize > 0 else max(1, len(data))
+    events.put(("onMessage", (connection, { "Status": status, "Headers": headers, "Data": data[:size] })))
+    for start in range(size, len(data), size):
+        events.put(("onMessage", (connection, { "Data": data[start:start + size] })))
+
+def runCallbacks(module, timeout = 0):
+    """Deliver the pending connection callbacks to the plugin module, returns the number of callbacks delivered"""
+    count = 0
+    try:
+        while True:
+            name, args = events.get(timeout=timeout) if count == 0 and timeout > 0 else events.get_nowait()
+            getattr(module, name)(*args)
+            count += 1
+    except queue.Empty:
+        pass
+    return count
+
+
+class Device:
+
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0, DeviceID="", Description=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = Options if Options is not None else {}
+        self.Used = Used
+        self.DeviceID = DeviceID
+        self.Description = Description
+        self.ID = Unit
+        self.nValue = 0
+        self.sValue = ""
+        self.LastLevel = 0
+        self.LastUpdate = ""
+
+    def Create(self):
+        stats["Create"] += 1
+        Devices[self.Unit] = self
+
+    def Update(self, nValue=0, sValue="", Image=None, SignalLevel=None, BatteryLevel=None, Options=None, TimedOut=0, Name=None, TypeName=None, Type=None, Subtype=None, Switchtype=None, Used=None, Description=None, Color=None, SuppressTriggers=False):
+        stats["Update"] += 1
+        self.nValue = nValue
+        self.sValue = sValue
+        if Options is not None:
+            self.Options = Options
+        if Name is not None:
+            self.Name = Name
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+    def __str__(self):
+        return "Unit: "+str(self.Unit)+", Name: '"+self.Name+"', nValue: "+str(self.nValue)+", sValue: '"+self.sValue+"'"
+
+
+class Connection:
+    """Outgoing HTTP connection, requests are sent in order by a worker thread"""
+
+    def __init__(self, Name="", Transport="TCP/IP", Protocol="HTTP", Address="127.0.0.1", Port="80"):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.timeout = 10
+        self.Parent = None
+        self._state = "disconnected"
+        self._requests = queue.Queue()
+
+    def Connect(self):
+        if self._state != "disconnected":
+            return
+        self._state = "connecting"
+        self._requests = queue.Queue()
+        threading.Thread(target=self._run, args=(self._requests,), daemon=True).start()
+
+    def Listen(self):
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                conn = Connection(Name=listener.Name, Transport=listener.Transport, Protocol=listener.Protocol,
+                                  Address=self.client_address[0], Port=str(self.client_address[1]))
+                conn.Parent = listener
+                conn._state = "connected"
+                conn._replies = queue.Queue()
+                events.put(("onMessage", (conn, { "Verb": "GET", "URL": self.path, "Headers": dict(self.headers), "Data": b"" })))
+                try:
+                    reply = conn._replies.get(timeout=120)
+                except queue.Empty:
+                    reply = None
+                conn._state = "disconnected"
+                if reply is None:
+                    self.close_connection = True
+                    events.put(("onDisconnect", (conn,)))
+                    return
+                code, sep, reason = reply.get("Status", "200 OK").partition(" ")
+                data = reply.get("Data", b"")
+                if isinstance(data, str):
+                    data = data.encode("utf-8")
+                self.send_response(int(code), reason)
+                for name, value in reply.get("Headers", {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.Address if self.Address else "127.0.0.1", int(self.Port)), Handler)
+        self._server.daemon_threads = True
+        self._state = "listening"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def Connected(self):
+        return self._state == "connected"
+
+    def Connecting(self):
+        return self._state == "connecting"
+
+    def Send(self, Message, Delay=0):
+        stats["Send"] += 1
+        if hasattr(self, "_replies"):
+            # reply to an incoming request
+            self._replies.put(Message)
+        elif self._state == "connected":
+            self._requests.put(Message)
+
+    def Disconnect(self):
+        if self._state == "listening":
+            self._server.shutdown()
+            self._server.server_close()
+            self._state = "disconnected"
+        elif self._state != "disconnected":
+            self._state = "disconnected"
+            self._requests.put(None)
+
+    def _run(self, requests):
+        conn = http.client.HTTPConnection(self.Address, int(self.Port), timeout=self.timeout)
+        try:
+            conn.connect()
+        except OSError as e:
+            self._state = "disconnected"
+            events.put(("onConnect", (self, 1, str(e))))
+            return
+        self._state = "connected"
+        events.put(("onConnect", (self, 0, "")))
+
+        while True:
+            message = requests.get()
+            if message is None or requests is not self._requests:
+                break
+            try:
+                conn.request(message.get("Verb", "GET"), message["URL"], headers=message.get("Headers", {}))
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                break
+            headers = dict(response.getheaders())
+            headers.pop("Transfer-Encoding", None)
+            headers["Content-Length"] = str(len(data))
+            queueMessage(self, str(response.status), headers, data)
+        conn.close()
+        if requests is self._requests:
+            self._state = "disconnected"
+            events.put(("onDisconnect", (self,)))
@@ -0,0 +1,303 @@
+# Benchmark of the plugin callbacks, outside of Domoticz
+#
+# Three modes:
+#   replay: the replies of the simulated Connection Box are computed in-process and delivered without any network,
+#           with a virtual clock: this measures the cost of the plugin callbacks only.
+#   live:   the plugin talks HTTP to a local Connection Box simulator (see cbox_simulator.py), in real time.
+#   client: the asyncio client of palazzetti.py polls the simulated boxes concurrently, without the plugin.
+#
+# Reports messages per second, latency percentiles of each callback and allocated memory blocks.
+#
+# Usage: python3 bench.py [replay|live|client] [--boxes 1] [--api lua] [--box-api both] [--heartbeats 5000] [--duration 30] [--latency 0.05] ...
+#
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import importlib
+import tracemalloc
+
+TOOLS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS_FOLDER)
+sys.path.insert(1, os.path.dirname(TOOLS_FOLDER))
+
+import Domoticz
+import cbox_simulator
+import palazzetti
+
+CALLBACKS = ("onStart", "onConnect", "onMessage", "onCommand", "onHeartbeat", "onDisconnect", "onStop")
+
+
+class VirtualClock:
+    """Stands for the time module of the plugin in replay mode"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return 1600000000.0 + self.now
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+    def localtime(self, seconds = None):
+        return time.localtime(self.time() if seconds is None else seconds)
+
+    def strftime(self, format, t = None):
+        return time.strftime(format, self.localtime() if t is None else t)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class ReplayConnection(Domoticz.Connection):
+    """Connection answered in-process by a simulator, without network"""
+
+    simulator = None
+    # (connection, api, command) sent and not answered yet
+    pending = []
+
+    def Connect(self):
+        if self._state == "disconnected":
+            self._state = "connected"
+            Domoticz.events.put(("onConnect", (self, 0, "")))
+
+    def Send(self, Message, Delay=0):
+        Domoticz.stats["Send"] += 1
+        if self._state != "connected":
+            return
+        path, sep, query = Message["URL"].partition("?")
+        api = "lua" if path.endswith(".lua") else "php"
+        self.pending.append((self, api, query.partition("cmd=")[2].replace("+", " ").strip().upper()))
+
+    @classmethod
+    def answer(cls):
+        """Queue the replies of the requests sent so far (outside of the timed callbacks)"""
+        for conn, api, cmd in cls.pending:
+            if conn._state != "connected":
+                continue
+            status, reply = cls.simulator.reply(api, cmd)
+            if reply is None:
+                conn.Disconnect()
+            else:
+                data = json.dumps(reply).encode("utf-8")
+                Domoticz.queueMessage(conn, str(status), { "Content-Length": str(len(data)) }, data)
+        del cls.pending[:]
+
+    def Disconnect(self):
+        if self._state != "disconnected":
+            self._state = "disconnected"
+            Domoticz.events.put(("onDisconnect", (self,)))
+
+
+class Recorder:
+    """Times the plugin callbacks and counts the memory blocks they keep allocated"""
+
+    def __init__(self, plugin, traceAlloc):
+        self.plugin = plugin
+        self.traceAlloc = traceAlloc
+        self.durations = dict((name, []) for name in CALLBACKS)
+        self.blocks = dict((name, 0) for name in CALLBACKS)
+        self.peaks = dict((name, 0) for name in CALLBACKS)
+        for name in CALLBACKS:
+            setattr(self, name, self.wrap(name))
+
+    def wrap(self, name):
+        callback = getattr(self.plugin, name)
+        durations = self.durations[name]
+
+        def timed(*args):
+            if self.traceAlloc:
+                tracemalloc.reset_peak()
+            blocks = sys.getallocatedblocks()
+            start = time.perf_counter()
+            callback(*args)
+            durations.append(time.perf_counter() - start)
+            self.blocks[name] += sys.getallocatedblocks() - blocks
+            if self.traceAlloc:
+                self.peaks[name] = max(self.peaks[name], tracemalloc.get_traced_memory()[1])
+        return timed
+
+    def report(self, elapsed):
+        messages = len(self.durations["onMessage"])
+        busy = sum(sum(d) for d in self.durations.values())
+        print("")
+        print("Messages: %d in %.2f s, %.1f messages/s (wall clock), %.0f messages/s (callback time)" %
+              (messages, elapsed, messages / elapsed if elapsed > 0 else 0, messages / busy if busy > 0 else 0))
+        print("Domoticz API: %(Update)d device updates, %(Send)d requests, %(Debug)d debug lines, %(Error)d errors" % Domoticz.stats)
+        print("")
+        print("%-12s %8s %10s %10s %10s %10s %12s%s" % ("callback", "calls", "p50 (us)", "p95 (us)", "p99 (us)", "max (us)", "net blocks",
+                                                     "  peak (KiB)" if self.traceAlloc else ""))
+        for name in CALLBACKS:
+            d = sorted(self.durations[name])
+            if not d:
+                continue
+            print("%-12s %8d %10.1f %10.1f %10.1f %10.1f %12d%s" % (name, len(d), percentile(d, 50) * 1e6, percentile(d, 95) * 1e6,
+                                                                 percentile(d, 99) * 1e6, d[-1] * 1e6, self.blocks[name],
+                                                                 "  %10.1f" % (self.peaks[name] / 1024) if self.traceAlloc else ""))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def loadPlugin(args, addresses, homeFolder):
+    Domoticz.reset()
+    Domoticz.quiet = not args.verbose
+    import plugin
+    plugin = importlib.reload(plugin)
+    Domoticz.setup(plugin, { "Key": "palazzetti-cbox", "Name": "Palazzetti", "HardwareID": 1, "HomeFolder": homeFolder + os.sep,
+                             "Address": addresses, "Port": "80", "Mode1": "", "Mode2": "", "Mode3": args.options,
+                             "Mode4": { "lua": "True", "php": "False" }.get(args.api, "Auto"), "Mode5": "", "Mode6": "Debug" if args.debug else "Normal" })
+    return plugin
+
+
+def boxApis(args):
+    """APIs served by the simulated boxes"""
+    return ("lua", "php") if args.box_api == "both" else (args.box_api,)
+
+
+def randomCommand(unitBase):
+    """(Unit, Command, Level) of a random user action on the devices of a box"""
+    choice = random.randrange(4)
+    if choice == 0:
+        return unitBase + 4, "Set Level", float(random.randint(16, 24))
+    if choice == 1:
+        return unitBase + 3, "Set Level", random.choice((10, 20, 30, 40, 50, 60))
+    if choice == 2:
+        return unitBase + 2, "Set Level", random.choice((10, 20, 30, 40, 50))
+    return unitBase + 9, random.choice(("On", "Off")), 0
+
+
+def replay(args, homeFolder):
+    clock = VirtualClock()
+    simulator = cbox_simulator.Simulator(errorRate=args.error_rate, disconnectRate=args.disconnect_rate, speed=args.speed,
+                                         apis=boxApis(args))
+    ReplayConnection.simulator = simulator
+    Domoticz.Connection = ReplayConnection
+
+    plugin = loadPlugin(args, ",".join("10.0.0.%d" % (i + 1) for i in range(args.boxes)), homeFolder)
+    plugin.time = clock
+    recorder = Recorder(plugin, args.trace_alloc)
+
+    start = time.perf_counter()
+    recorder.onStart()
+    for beat in range(args.heartbeats):
+        ReplayConnection.answer()
+        Domoticz.runCallbacks(recorder)
+        clock.sleep(Domoticz.heartbeat)
+        recorder.onHeartbeat()
+        if args.command_every and beat % args.command_every == 0:
+            recorder.onCommand(*randomCommand(random.randrange(args.boxes) * plugin.UNITS_PER_BOX), 0)
+    ReplayConnection.answer()
+    Domoticz.runCallbacks(recorder)
+    recorder.onStop()
+    recorder.report(time.perf_counter() - start)
+
+
+def live(args, homeFolder):
+    servers = [cbox_simulator.start(0, latency=args.latency, jitter=args.jitter, errorRate=args.error_rate,
+                                    disconnectRate=args.disconnect_rate, speed=args.speed, apis=boxApis(args))[0]
+               for i in range(args.boxes)]
+    plugin = loadPlugin(args, ",".join("127.0.0.1:%d" % server.server_address[1] for server in servers), homeFolder)
+    recorder = Recorder(plugin, args.trace_alloc)
+
+    start = time.perf_counter()
+    recorder.onStart()
+    nextBeat = time.monotonic() + Domoticz.heartbeat
+    beat = 0
+    while time.perf_counter() - start < args.duration:
+        Domoticz.runCallbacks(recorder, timeout=max(0.001, nextBeat - time.monotonic()))
+        if time.monotonic() >= nextBeat:
+            nextBeat += Domoticz.heartbeat
+            recorder.onHeartbeat()
+            beat += 1
+            if args.command_every and beat % args.command_every == 0:
+                recorder.onCommand(*randomCommand(random.randrange(args.boxes) * plugin.UNITS_PER_BOX), 0)
+    recorder.onStop()
+    Domoticz.runCallbacks(recorder)
+    for server in servers:
+        server.shutdown()
+    recorder.report(time.perf_counter() - start)
+
+
+def client(args):
+    servers = [cbox_simulator.start(0, latency=args.latency, jitter=args.jitter, errorRate=args.error_rate,
+                                    disconnectRate=args.disconnect_rate, speed=args.speed, apis=boxApis(args))[0]
+               for i in range(args.boxes)]
+    # the client does not detect the API
+    api = args.api if args.api != "auto" else boxApis(args)[0]
+    clients = [palazzetti.Client("127.0.0.1", server.server_address[1], api=api) for server in servers]
+    durations = []
+    failures = 0
+
+    async def run():
+        nonlocal failures
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            t = time.perf_counter()
+            states = await palazzetti.pollMany(clients)
+            durations.append(time.perf_counter() - t)
+            failures += sum(1 for state in states if not isinstance(state, palazzetti.StoveState))
+        for c in clients:
+            await c.close()
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    for server in servers:
+        server.shutdown()
+
+    polls = len(durations) * len(clients)
+    d = sorted(durations)
+    print("")
+    print("Polls: %d in %.2f s, %.1f polls/s, %d failed, %d connections opened" %
+          (polls, elapsed, polls / elapsed, failures, sum(c.connects for c in clients)))
+    print("Round of %d boxes: p50 %.1f ms, p95 %.1f ms, max %.1f ms" %
+          (len(clients), percentile(d, 50) * 1e3, percentile(d, 95) * 1e3, d[-1] * 1e3))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark of the Palazzetti plugin callbacks")
+    parser.add_argument("mode", nargs="?", choices=("replay", "live", "client"), default="replay")
+    parser.add_argument("--boxes", type=int, default=1, help="number of simulated Connection Boxes")
+    parser.add_argument("--api", choices=("lua", "php", "auto"), default="lua", help="Connection Box API parameter of the plugin")
+    parser.add_argument("--box-api", choices=("both", "lua", "php"), default="both", help="API(s) served by the simulated boxes")
+    parser.add_argument("--options", default='{ "normalPoll": 2, "idlePoll": 2 }', help="Advanced Options parameter of the plugin")
+    parser.add_argument("--heartbeats", type=int, default=5000, help="replay: number of heartbeats")
+    parser.add_argument("--duration", type=float, default=30, help="live, client: duration in seconds")
+    parser.add_argument("--command-every", type=int, default=10, help="send a random user command every N heartbeats (0: never)")
+    parser.add_argument("--latency", type=float, default=0.0, help="live: reply latency of the simulator, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="live: random extra latency, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="ratio of RSP ERROR replies")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="ratio of requests dropping the connection")
+    parser.add_argument("--fragment", type=int, default=0, help="deliver the replies in fragments of this size, in bytes")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed of the simulated stove time")
+    parser.add_argument("--trace-alloc", action="store_true", help="also report the peak memory of each callback (slower)")
+    parser.add_argument("--debug", action="store_true", help="run the plugin in Debug mode")
+    parser.add_argument("--verbose", action="store_true", help="print the plugin logs")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    Domoticz.fragmentSize = args.fragment
+    if args.trace_alloc:
+        tracemalloc.start()
+
+    with tempfile.TemporaryDirectory() as homeFolder:
+        if args.mode == "replay":
+            replay(args, homeFolder)
+        elif args.mode == "client":
+            client(args)
+        else:
+            live(args, homeFolder)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,259 @@
+# Palazzetti Connection Box simulator
+#
+# Local HTTP stand-in for a Connection Box, serving both APIs:
+#   /cgi-bin/sendmsg.lua?cmd=...   (LUA API)
+#   /sendmsg.php?cmd=...           (PHP API)
+# GET+ALLS and GET+CHRD return the recorded payloads of the payloads folder, updated with the simulated stove state.
+# SET+... and CMD+... commands change the simulated stove state and return the same reply as a real box.
+# SET+CPRD and SET+CDAY change the chrono program returned by GET+CHRD, and reply with it.
+# Latency, errors and disconnects can be injected. A box serving one API only answers 404 to the other one.
+#
+# Usage: python3 cbox_simulator.py [--port 8080] [--api both] [--latency 0.05] [--error-rate 0.01] [--disconnect-rate 0.01]
+#
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote
+
+PAYLOADS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads")
+
+# field -> JSON key per API
+KEYS = {
+    "lua": { "STATUS": "STATUS", "POWER": "PWR", "SETP": "SETP", "FAN_FAN2LEVEL": "F2L", "CHRSTATUS": "CHRSTATUS",
+             "PELLET_QTUSED": "PQT", "TMP_ROOM": "T5" },
+    "php": { "STATUS": "STATUS", "POWER": "POWER", "SETP": "SETP", "FAN_FAN2LEVEL": "FAN_FAN2LEVEL", "CHRSTATUS": "CHRSTATUS",
+             "PELLET_QTUSED": "PELLET_QTUSED", "TMP_ROOM": "TMP_ROOM_WATER" }
+}
+
+# command -> (state field, PHP reply container)
+SET_COMMANDS = { "SET SETP": ("SETP", "Setpoint"),
+                 "SET RFAN": ("FAN_FAN2LEVEL", "RoomFan"),
+                 "SET POWR": ("POWER", "Power"),
+                 "SET CSST": ("CHRSTATUS", "Chrono Info") }
+
+# chrono commands -> number of arguments
+CHRONO_COMMANDS = { "SET CPRD": 6, "SET CDAY": 3 }
+
+# stove status sequence after CMD ON / CMD OFF: (status, duration in s)
+ON_SEQUENCE = ((2, 5), (3, 20), (4, 20), (5, 10), (6, None))
+OFF_SEQUENCE = ((10, 20), (11, 20), (0, None))
+
+# pellet consumption in kg/h per power level, while burning
+PELLET_RATE = { 1: 0.6, 2: 0.9, 3: 1.2, 4: 1.5, 5: 1.9 }
+
+
+class Stove:
+    """Simulated stove state, shared by all the connections"""
+
+    def __init__(self, speed = 1.0):
+        self.lock = threading.Lock()
+        self.speed = speed
+        self.state = { "STATUS": 6, "POWER": 3, "SETP": 21, "FAN_FAN2LEVEL": 2, "CHRSTATUS": 0, "PELLET_QTUSED": 1234, "TMP_ROOM": 20.5 }
+        self.sequence = ()
+        self.sequenceStart = 0
+        self.pellets = float(self.state["PELLET_QTUSED"])
+        self.lastUpdate = time.monotonic()
+        with open(os.path.join(PAYLOADS_FOLDER, "lua_GET+CHRD.json")) as f:
+            data = json.load(f)["DATA"]
+        self.chrono = { "Programs": data["Programs"], "Days": data["Days"] }
+
+    def update(self):
+        now = time.monotonic()
+        elapsed = (now - self.lastUpdate) * self.speed
+        self.lastUpdate = now
+
+        if self.state["STATUS"] == 6:
+            self.pellets += PELLET_RATE.get(self.state["POWER"], 1.0) * elapsed / 3600
+            self.state["PELLET_QTUSED"] = int(self.pellets)
+
+        # walk the ON/OFF sequence
+        t = (now - self.sequenceStart) * self.speed
+        for status, duration in self.sequence:
+            self.state["STATUS"] = status
+            if duration is None or t < duration:
+                break
+            t -= duration
+
+    def chronoCommand(self, cmd, args):
+        args = [int(arg) for arg in args]
+        if len(args) != CHRONO_COMMANDS[cmd]:
+            raise ValueError(cmd)
+        if cmd == "SET CPRD":
+            program, setpoint, startHour, startMinute, stopHour, stopMinute = args
+            if not 1 <= program <= 6:
+                raise ValueError(cmd)
+            self.chrono["Programs"]["P%d" % program] = { "START": "%02d:%02d" % (startHour, startMinute),
+                                                         "STOP": "%02d:%02d" % (stopHour, stopMinute), "SETP": setpoint }
+        else:
+            day, slot, program = args
+            if not (1 <= day <= 7 and 1 <= slot <= 3 and 0 <= program <= 6):
+                raise ValueError(cmd)
+            self.chrono["Days"]["D%d" % day]["M%d" % slot] = "P%d" % program if program else "OFF"
+
+    def command(self, cmd, args):
+        self.update()
+        if cmd == "CMD ON":
+            self.sequence = ON_SEQUENCE
+        elif cmd == "CMD OFF":
+            self.sequence = OFF_SEQUENCE
+        else:
+            field, container = SET_COMMANDS[cmd]
+            self.state[field] = int(args[0])
+            return field
+        self.sequenceStart = time.monotonic()
+        self.update()
+        return "STATUS"
+
+
+class Simulator:
+
+    def __init__(self, latency = 0.0, jitter = 0.0, errorRate = 0.0, disconnectRate = 0.0, speed = 1.0, apis = ("lua", "php")):
+        self.apis = apis
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.disconnectRate = disconnectRate
+        self.stove = Stove(speed)
+        self.payloads = {}
+        for api in ("lua", "php"):
+            for cmd in ("GET+ALLS", "GET+CHRD"):
+                with open(os.path.join(PAYLOADS_FOLDER, api+"_"+cmd+".json")) as f:
+                    self.payloads[(api, cmd.replace("+", " "))] = json.load(f)
+        self.requests = 0
+
+    def reply(self, api, cmd):
+        """(HTTP status, reply dict), reply is None to drop the connection"""
+        self.requests += 1
+        if api not in self.apis:
+            return 404, { "error": "Not Found" }
+        if random.random() < self.disconnectRate:
+            return 200, None
+
+        words = cmd.split(" ")
+        name = " ".join(words[:2])
+        info = { "CMD": cmd, "RSP": "OK", "TS": int(time.time()) } if api == "lua" else { "RSP": "OK" }
+        infoKey = "INFO" if api == "lua" else "Info"
+
+        if random.random() < self.errorRate:
+            info["RSP"] = "ERROR"
+            return 200, { infoKey: info }
+
+        keys = KEYS[api]
+        stove = self.stove
+        with stove.lock:
+            if (api, name) in self.payloads:
+                stove.update()
+                reply = copy.deepcopy(self.payloads[(api, name)])
+                data = reply["DATA"] if api == "lua" else reply["All Data" if name == "GET ALLS" else "Chrono Info"]
+                for field, value in stove.state.items():
+                    if keys[field] in data:
+                        data[keys[field]] = value
+                if "Programs" in data:
+                    data.update(copy.deepcopy(stove.chrono))
+                reply[infoKey] = info
+                return 200, reply
+
+            if name in CHRONO_COMMANDS:
+                try:
+                    stove.chronoCommand(name, words[2:])
+                except (KeyError, ValueError):
+                    info["RSP"] = "ERROR"
+                    return 200, { infoKey: info }
+                data = copy.deepcopy(stove.chrono)
+                data["CHRSTATUS"] = stove.state["CHRSTATUS"]
+                return 200, { infoKey: info, "DATA" if api == "lua" else "Chrono Info": data }
+
+            if name in SET_COMMANDS or name in ("CMD ON", "CMD OFF"):
+                try:
+                    field = stove.command(name, words[2:])
+                except (IndexError, ValueError):
+                    info["RSP"] = "ERROR"
+                    return 200, { infoKey: info }
+                container = "DATA" if api == "lua" else (SET_COMMANDS[name][1] if name in SET_COMMANDS else "Status")
+                return 200, { infoKey: info, container: { keys[field]: stove.state[field] } }
+
+        info["RSP"] = "ERROR"
+        return 200, { infoKey: info }
+
+
+def makeHandler(simulator):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body in one segment, like the box: no Nagle / delayed ACK stall between them
+        wbufsize = -1
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/cgi-bin/sendmsg.lua":
+                api = "lua"
+            elif url.path == "/sendmsg.php":
+                api = "php"
+            else:
+                self.send(404, b"Not Found")
+                return
+
+            # ?cmd=GET+ALLS: '+' are spaces
+            cmd = unquote(url.query.partition("cmd=")[2].replace("+", " ")).strip().upper()
+
+            delay = simulator.latency + random.uniform(0, simulator.jitter)
+            if delay > 0:
+                time.sleep(delay)
+
+            status, reply = simulator.reply(api, cmd)
+            if reply is None:
+                self.close_connection = True
+                return
+            self.send(status, json.dumps(reply).encode("utf-8"))
+
+        def send(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start(port = 0, **kwargs):
+    """Start a simulator in a background thread, returns (server, simulator). port 0 picks a free port."""
+    simulator = Simulator(**kwargs)
+    server = ThreadingHTTPServer(("127.0.0.1", port), makeHandler(simulator))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, simulator
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Palazzetti Connection Box simulator")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--api", choices=("both", "lua", "php"), default="both", help="API(s) served")
+    parser.add_argument("--latency", type=float, default=0.0, help="reply latency, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="ratio of RSP ERROR replies")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="ratio of requests dropping the connection")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed of the simulated stove time")
+    args = parser.parse_args(argv)
+
+    server, simulator = start(args.port, latency=args.latency, jitter=args.jitter, errorRate=args.error_rate,
+                              disconnectRate=args.disconnect_rate, speed=args.speed,
+                              apis=("lua", "php") if args.api == "both" else (args.api,))
+    print("Connection Box simulator listening on http://127.0.0.1:"+str(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])